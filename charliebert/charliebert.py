@@ -7,12 +7,16 @@ except:
     import queue as Q # For python 3
 import logging
 from logging.handlers import RotatingFileHandler
-import re
 import os
 from userInterface import UserInterface
 from sonosInterface import SonosInterface
 from mpdInterface import MpdInterface
 from extractCovers import ExtractCovers
+from volumeController import VolumeController
+from lifecycleManager import LifecycleManager, Stopper
+from maintenanceWorker import MaintenanceWorker, testProgressJob, createPlaylistKeyJob, importPlaylistsJob
+from commands import PlayPause, Forward, Back, StartPlaylist, StartAltPlaylist, PlayTrack, AdjustVolume, \
+    Shutdown, RunCommand, SelectRoom, SelectNetwork, SetNetworkAndRoom, Diagnostics, SignalingQueue
 from datetime import datetime
 try:
     import ConfigParser as configparser # For python 2
@@ -32,7 +36,16 @@ class UserInterfaceThread(threading.Thread):
         self.reset = reset
         self.logger = logger
 
-        self.ui = UserInterface(self.logger)
+        # GPIO port receiving the interrupts of the MCP23017 ('none' if the INTB line is not wired)
+        mcpInterruptPort = 4
+        try:
+            if config.has_option('UserInterface', 'mcpInterruptPort'):
+                value = config.get('UserInterface', 'mcpInterruptPort')
+                mcpInterruptPort = None if value.lower() == 'none' else int(value)
+        except:
+            self.logger.error("Problem encountered when attempting to set the MCP interrupt port from config")
+
+        self.ui = UserInterface(self.logger, mcpInterruptPort)
         
     def run(self):
         self.logger.debug("UserInterfaceThread starting")
@@ -40,7 +53,7 @@ class UserInterfaceThread(threading.Thread):
         self.logger.debug("UserInterfaceThread stopping")
 
 class PlayerInterfaceThread(threading.Thread):
-    def __init__(self, stopper, u2pQ, p2uQ, shutdownPi, logger, config):
+    def __init__(self, stopper, u2pQ, p2uQ, shutdownPi, logger, config, maintenanceWorker):
         super(PlayerInterfaceThread, self).__init__()
         self.config = config        
         self.logger = logger
@@ -76,16 +89,49 @@ class PlayerInterfaceThread(threading.Thread):
         self.playlistBasename = "zCharliebert"
         self.availablePlayers = ('Sonos', 'Mpd')
         self.player = "Sonos"
+        # UNIX socket of the MPD server (use TCP on localhost if not defined)
+        self.mpdSocket = None
+        # Maximum download rate (bytes/s) when copying music files for MPD (no limit if not defined)
+        self.copyBandwidthLimit = None
+        # Number of files copied in parallel, and maximum number of SMB connections to a single server
+        self.copyWorkers = 4
+        self.maxConnectionsPerServer = 2
         
         self.readConfig()
         
         self.sendInitialNetworkAndRoomState()
         
-        self.parser = re.compile("^([A-Z/]+)(\s+([A-Z]+))*(\s+([-0-9]+))*\s*$")
+        # Runs the long maintenance jobs in a separate process
+        self.maintenanceWorker = maintenanceWorker
+        
+        # Merges the volume changes from the rotary encoder
+        self.volumeController = VolumeController(self.logger)
+        
+        # Handlers of the commands from the user interface
+        self.handlers = {PlayPause: self.playPause,
+                         Forward: self.forward,
+                         Back: self.back,
+                         StartPlaylist: self.startPlaylist,
+                         StartAltPlaylist: self.startPlaylist,
+                         PlayTrack: self.playTrack,
+                         AdjustVolume: self.adjustVolume,
+                         Shutdown: self.shutdown,
+                         RunCommand: self.runCommand,
+                         SelectRoom: self.selectRoom,
+                         SelectNetwork: self.selectNetwork}
+        # Maintenance commands (COMMAND n)
+        self.maintenanceCommands = {1: self.testProgress,
+                                    2: self.cancelMaintenance,
+                                    3: self.logDiagnostics,
+                                    7: self.createPlaylistKey,
+                                    10: self.importPlaylistsSoft,
+                                    11: self.importPlaylistsMedium,
+                                    12: self.importPlaylistsHard}
         self.shutdownPi = shutdownPi
 
         self.si = SonosInterface(self.logger)
-        self.mi = MpdInterface(self.logger)
+        self.si.setNetwork(self.network)
+        self.mi = MpdInterface(self.logger, socketPath=self.mpdSocket, **self.getCopySettings())
 
         if self.player == 'Sonos':        
             self.pi = self.si
@@ -137,6 +183,48 @@ class PlayerInterfaceThread(threading.Thread):
         except:
             self.logger.error("Problem encountered when attempting to set player from config")
                     
+        try:
+            if config.has_option('PlayerInterface', 'mpdSocket'):
+                cfgMpdSocket = config.get('PlayerInterface', 'mpdSocket')
+                if os.path.exists(cfgMpdSocket):
+                    self.mpdSocket = cfgMpdSocket
+                else:
+                    self.logger.error("MPD socket from config does not exist: {}".format(cfgMpdSocket))
+        except:
+            self.logger.error("Problem encountered when attempting to set the MPD socket from config")
+                    
+        try:
+            if config.has_option('PlayerInterface', 'copyBandwidthLimit'):
+                self.copyBandwidthLimit = config.getint('PlayerInterface', 'copyBandwidthLimit')
+        except:
+            self.logger.error("Problem encountered when attempting to set the copy bandwidth limit from config")
+                    
+        try:
+            if config.has_option('PlayerInterface', 'copyWorkers'):
+                cfgCopyWorkers = config.getint('PlayerInterface', 'copyWorkers')
+                if cfgCopyWorkers >= 1:
+                    self.copyWorkers = cfgCopyWorkers
+                else:
+                    self.logger.error("Invalid number of copy workers from config: {:d}".format(cfgCopyWorkers))
+        except:
+            self.logger.error("Problem encountered when attempting to set the number of copy workers from config")
+                    
+        try:
+            if config.has_option('PlayerInterface', 'maxConnectionsPerServer'):
+                cfgMaxConnections = config.getint('PlayerInterface', 'maxConnectionsPerServer')
+                if cfgMaxConnections >= 1:
+                    self.maxConnectionsPerServer = cfgMaxConnections
+                else:
+                    self.logger.error("Invalid maximum number of connections per server from config: {:d}".format(cfgMaxConnections))
+        except:
+            self.logger.error("Problem encountered when attempting to set the maximum number of connections per server from config")
+                    
+    # Settings of MpdInterface for copying music files
+    def getCopySettings(self):
+        return {'copyWorkers': self.copyWorkers, 
+                'maxConnectionsPerServer': self.maxConnectionsPerServer, 
+                'copyBandwidthLimit': self.copyBandwidthLimit}
+                    
     def saveConfig(self):
         self.logger.debug("Saving current configuration of the player interface")
         self.logger.debug("Current room: {}".format(self.room))
@@ -166,7 +254,7 @@ class PlayerInterfaceThread(threading.Thread):
                 roomIndex = self.availableRoomIndices[self.room]
                 self.logger.debug("room index: {}".format(roomIndex))
             self.logger.debug("Sending initial network ({:d}) and room ({:d}) indices to the user interface".format(networkIndex, roomIndex))
-            self.p2uQ.put("NETWORK/ROOM {:d}; {:d}".format(networkIndex, roomIndex))
+            self.p2uQ.put(SetNetworkAndRoom(networkIndex, roomIndex))
         except:
             self.logger.error("An error occurred while sending the initial network and room indices to the user interface")
 
@@ -174,201 +262,200 @@ class PlayerInterfaceThread(threading.Thread):
         self.logger.debug("PlayerInterfaceThread starting")
         try:
             while not self.stopper.is_set():
-                #time.sleep(1)
-                self.logger.debug("Player Interface: Waiting for a command to execute")
-                command = self.u2pQ.get()
+                # Wait for a command, or until the next volume step is due
+                timeout = self.volumeController.getTimeout()
+                try:
+                    if timeout is None:
+                        self.logger.debug("Player Interface: Waiting for a command to execute")
+                        command = self.u2pQ.get()
+                    else:
+                        command = self.u2pQ.get(timeout=timeout)
+                except Q.Empty:
+                    self.stepVolume()
+                    continue
                 if command is None:
                     break
-                self.logger.debug("Player Interface: Obtained command {}".format(command))
+                self.logger.debug("Player Interface: Obtained command %s", command)
                 self.u2pQ.task_done()
 
-                # Process commands using the following mini-parser: 'CMD [BANK] [VALUE]'
-                m = self.parser.match(command)
+                handler = self.handlers.get(type(command))
+                if handler is None:
+                    self.logger.error("Unrecognized command: '%s'", command)
+                    continue
                 try:
-                    if m.group(1) == "PLAY/PAUSE":
-                        self.logger.debug("Command PLAY/PAUSE")
-                        self.pi.togglePlayPause(self.room)
-                    elif m.group(1) == "FORWARD":
-                        self.logger.debug("Command FORWARD")
-                        self.pi.skipToNext(self.room)
-                    elif m.group(1) == "BACK":
-                        self.logger.debug("Command BACK")
-                        self.pi.skipToPrevious(self.room)
-                    elif m.group(1) == "PLAYLIST":
-                        bank = m.group(3)
-                        bankNb = int(m.group(5))
-                        self.logger.debug("Command PLAYLIST: {} {:d}".format(bank, bankNb))
-                        playlistName = "{0}_{1}{2:02d}".format(self.playlistBasename, bank, bankNb)
-                        self.logger.debug("Starting playlist {}".format(playlistName))
-                        self.pi.startPlaylist(playlistName, self.room)
-                    elif m.group(1) == "ALTPLAYLIST":
-                        bank = m.group(3)
-                        bankNb = int(m.group(5))
-                        self.logger.debug("Command PLAYLIST: {} {:d}".format(bank, bankNb))
-                        playlistName = "{0}_{1}{2:02d}".format(self.playlistBasename, bank, bankNb)
-                        self.logger.debug("Starting playlist {}".format(playlistName))
-                        self.pi.startPlaylistAlt(playlistName, self.room)
-                    elif m.group(1) == "TRACK":
-                        trackNb = int(m.group(5))
-                        self.logger.debug("Command TRACK: {:d}".format(trackNb))
-                        self.pi.playTrackNb(trackNb, self.room)
-                    elif m.group(1) == "VOLUME":
-                        volDelta = int(m.group(5))
-                        self.logger.debug("Command VOLUME: {:d}".format(volDelta))
-                        self.pi.adjustVolume(volDelta, self.room)
-                    elif m.group(1) == "SHUTDOWN":
-                        self.logger.debug("Command SHUTDOWN")
-                        ## Hack to work around the need for a password when using sudo:
-                        ## sudo chmod u+s /sbin/shutdown
-                        ## (using sleep to delay the actual shutdown, so as to leave time for the python program to quit properly)
-                        #os.system("( sleep 2; /sbin/shutdown -h now ) &")
-                        self.shutdownPi.set()
-
-                        try:
-                            self.logger.debug("Setting stopper to stop charliebert before shutting down the pi " + \
-                                          "(otherwise the shutdown thread will survive for the next startup)")
-                            self.stopper.set()
-                        except:
-                            self.logger.debug("Could not set stopper")
-
-                    elif m.group(1) == "COMMAND":
-                        commandNb = int(m.group(5))
-                        self.logger.debug("Command COMMAND: {:d}".format(commandNb))
-
-                        if commandNb == 1:
-                            self.p2uQ.put("PROGRESS START")
-                            time.sleep(10)
-                            self.p2uQ.put("PROGRESS STOP")
-                        elif commandNb == 7:
-                            self.p2uQ.put("PROGRESS START")
-                            self.extractCovers.createPlaylistKey()
-                            self.p2uQ.put("PROGRESS STOP")
-                        elif commandNb == 10:
-                            # Import sonos playlists - soft 
-                            # (only retrieve not yet exported sonos playlists,
-                            # and only copy not yet copied music files)
-                            self.p2uQ.put("PROGRESS START")
-                            self.logger.debug("Exporting sonos playlists...")
-                            self.si.exportAllPlaylists(u'Office')            
-                            self.logger.debug("Done.")
-                            
-                            self.logger.debug("Importing playlists into MPD...")
-                            self.mi.importAllPlaylists(u'Office')            
-                            self.logger.debug("Done.")                                                                                                   
-                            self.p2uQ.put("PROGRESS STOP")
-                        elif commandNb == 11:
-                            # Import sonos playlists - medium
-                            # (renew sonos playlist definitions,
-                            # but only copy not yet copied music files)
-                            self.p2uQ.put("PROGRESS START")
-                            self.logger.debug("Exporting sonos playlists...")
-                            self.si.exportAllPlaylists(u'Office', True)            
-                            self.logger.debug("Done.")
-                            
-                            self.logger.debug("Importing playlists into MPD...")
-                            self.mi.importAllPlaylists(u'Office')            
-                            self.logger.debug("Done.")                                                                                                   
-                            self.p2uQ.put("PROGRESS STOP")
-                        elif commandNb == 12:
-                            # Import sonos playlists - hard
-                            # (renew sonos playlist definitions,
-                            # and also overwrite already copied music files)
-                            self.p2uQ.put("PROGRESS START")
-                            self.logger.debug("Exporting sonos playlists...")
-                            self.si.exportAllPlaylists(u'Office', True)            
-                            self.logger.debug("Done.")
-                            
-                            self.logger.debug("Importing playlists into MPD...")
-                            self.mi.importAllPlaylists(u'Office', True)
-                            self.logger.debug("Done.")                                                                                                   
-                            self.p2uQ.put("PROGRESS STOP")
-
-                        else:
-                            self.logger.error("Command COMMAND: {:d}: Command does not exist".format(commandNb))
-
-                        self.logger.debug("Current room: {}".format(self.room))
-                        self.logger.debug("Current network: {}".format(self.network))
-                        
-                        # Save current configuration for next start
-                        self.saveConfig()
-
-                    elif m.group(1) == "ROOM":
-                        roomNb = int(m.group(5))
-                        self.logger.debug("Command ROOM: {:d}".format(roomNb))
-
-                        if self.network == "aagmr":
-                            if roomNb == 1:
-                                self.room = "Bedroom"
-                            elif roomNb == 2:
-                                self.room = "Bathroom"
-                            elif roomNb == 3:
-                                self.room = "Office"  
-                            elif roomNb == 4:
-                                self.room = "Kitchen"  
-                            elif roomNb == 5:
-                                self.room = "Living Room"  
-                            elif roomNb == 6:
-                                self.room = "Charlie's Room"
-                            elif roomNb == 9:
-                                self.logger.debug("Exporting sonos playlists...")
-                                self.si.exportAllPlaylists(u'Office')            
-                                self.logger.debug("Done.")
-                                
-                                self.logger.debug("Importing playlists into MPD...")
-                                self.mi.importAllPlaylists(u'Office')            
-                                self.logger.debug("Done.")                                                                                                   
-                            else:
-                                self.logger.error("Command ROOM: {:d}: Room does not exist".format(roomNb))
-                        elif self.network == "AP2":
-                            if roomNb % 2 == 0:
-                                self.room = "Wohnzimmer"
-                            else:
-                                self.room = "Obenauf"
-                        else:
-                            self.room = "Charliebert"
-
-                        self.logger.debug("Current room: {}".format(self.room))
-                        
-                        # Save current configuration for next start
-                        self.saveConfig()
-
-                    elif m.group(1) == "NET":
-                        networkNb = int(m.group(5))
-                        self.logger.debug("Command NET: {:d}".format(networkNb))
-
-                        if networkNb == 1 or networkNb == 2:
-                            if self.player != "Sonos":
-                                self.player = "Sonos"
-                                self.logger.debug("Switching player to Sonos")
-                                self.pi = self.si
-                            if networkNb == 2:
-                                self.changeNetwork("aagmr")
-                            elif networkNb == 1:
-                                self.changeNetwork("AP2")
-                        elif networkNb == 3:
-                            if self.player != "Mpd":
-                                self.player = "Mpd"
-                                self.logger.debug("Switching player to MPD")
-                                self.pi = self.mi
-                        else:
-                            self.logger.error("Command NET {:d}: Network does not exist".format(networkNb))
-
-                        self.logger.debug("Current Network: {}".format(self.network))
-                        
-                        # Save current configuration for next start
-                        self.saveConfig()
-                    else:
-                       raise 
+                    handler(command)
                 except:
-                    self.logger.error("Unrecognized command: '{}'".format(command))
+                    self.logger.error("Problem executing command: '%s'", command)
+                    
+                self.stepVolume()
                 
         except KeyboardInterrupt:
             self.logger.debug("Player Interface stopped (Ctrl-C)")
         self.logger.debug("PlayerInterfaceThread stopping")
+        self.logger.debug("Volume controller: {}".format(self.volumeController.getStats()))
 
         # Save config before quitting (possibly useless, as it may occur only after writeConfig())
         self.saveConfig()
         
+        # Stop a maintenance job still running, and close the connections to the music systems
+        self.maintenanceWorker.stop()
+        self.si.close()
+        self.mi.close()
+        
+    def playPause(self, command):
+        self.pi.togglePlayPause(self.room)
+        
+    def forward(self, command):
+        self.pi.skipToNext(self.room)
+        
+    def back(self, command):
+        self.pi.skipToPrevious(self.room)
+        
+    def startPlaylist(self, command):
+        playlistName = "{0}_{1}{2:02d}".format(self.playlistBasename, command.bank, command.bankNb)
+        self.logger.debug("Starting playlist {}".format(playlistName))
+        if isinstance(command, StartAltPlaylist):
+            self.pi.startPlaylistAlt(playlistName, self.room)
+        else:
+            self.pi.startPlaylist(playlistName, self.room)
+        
+    def playTrack(self, command):
+        self.pi.playTrackNb(command.trackNb, self.room)
+        
+    # Volume changes are merged, and applied by stepVolume
+    def adjustVolume(self, command):
+        self.volumeController.add(command.volumeDelta)
+        
+    def stepVolume(self):
+        self.volumeController.step(lambda volumeDelta: self.pi.adjustVolume(volumeDelta, self.room))
+        
+    def shutdown(self, command):
+        ## Hack to work around the need for a password when using sudo:
+        ## sudo chmod u+s /sbin/shutdown
+        ## (using sleep to delay the actual shutdown, so as to leave time for the python program to quit properly)
+        #os.system("( sleep 2; /sbin/shutdown -h now ) &")
+        self.shutdownPi.set()
+
+        try:
+            self.logger.debug("Setting stopper to stop charliebert before shutting down the pi " + \
+                          "(otherwise the shutdown thread will survive for the next startup)")
+            self.stopper.set()
+        except:
+            self.logger.debug("Could not set stopper")
+            
+    def runCommand(self, command):
+        commandNb = command.commandNb
+        function = self.maintenanceCommands.get(commandNb)
+        if function is None:
+            self.logger.error("Command COMMAND: {:d}: Command does not exist".format(commandNb))
+        else:
+            function()
+
+        self.logger.debug("Current room: {}".format(self.room))
+        self.logger.debug("Current network: {}".format(self.network))
+        
+        # Save current configuration for next start
+        self.saveConfig()
+        
+    # Long maintenance jobs run in the background (see MaintenanceWorker), reporting their progress
+    def testProgress(self):
+        self.maintenanceWorker.start("testProgress", testProgressJob)
+        
+    def createPlaylistKey(self):
+        settings = dict((name, getattr(self.extractCovers, name)) for name in ('pdflatexPath', 'mp4artPath', 'ffmpegPath'))
+        self.maintenanceWorker.start("createPlaylistKey", createPlaylistKeyJob, settings)
+        
+    def importPlaylists(self, renewPlaylists, overwriteFiles):
+        self.maintenanceWorker.start("importPlaylists", importPlaylistsJob, self.network, self.mpdSocket, 
+                                     self.getCopySettings(), renewPlaylists, overwriteFiles)
+        
+    # Import sonos playlists - soft 
+    # (only retrieve not yet exported sonos playlists,
+    # and only copy not yet copied music files)
+    def importPlaylistsSoft(self):
+        self.importPlaylists(False, False)
+        
+    # Import sonos playlists - medium
+    # (renew sonos playlist definitions,
+    # but only copy not yet copied music files)
+    def importPlaylistsMedium(self):
+        self.importPlaylists(True, False)
+        
+    # Import sonos playlists - hard
+    # (renew sonos playlist definitions,
+    # and also overwrite already copied music files)
+    def importPlaylistsHard(self):
+        self.importPlaylists(True, True)
+        
+    def cancelMaintenance(self):
+        self.maintenanceWorker.cancel()
+        
+    # Log the statistics of both threads
+    def logDiagnostics(self):
+        self.logger.debug("Volume controller: {}".format(self.volumeController.getStats()))
+        self.p2uQ.put(Diagnostics())
+        
+    def selectRoom(self, command):
+        roomNb = command.roomNb
+        # Pending volume changes were meant for the previous room
+        self.volumeController.drop()
+
+        if self.network == "aagmr":
+            if roomNb == 1:
+                self.room = "Bedroom"
+            elif roomNb == 2:
+                self.room = "Bathroom"
+            elif roomNb == 3:
+                self.room = "Office"  
+            elif roomNb == 4:
+                self.room = "Kitchen"  
+            elif roomNb == 5:
+                self.room = "Living Room"  
+            elif roomNb == 6:
+                self.room = "Charlie's Room"
+            elif roomNb == 9:
+                self.importPlaylistsSoft()
+            else:
+                self.logger.error("Command ROOM: {:d}: Room does not exist".format(roomNb))
+        elif self.network == "AP2":
+            if roomNb % 2 == 0:
+                self.room = "Wohnzimmer"
+            else:
+                self.room = "Obenauf"
+        else:
+            self.room = "Charliebert"
+
+        self.logger.debug("Current room: {}".format(self.room))
+        
+        # Save current configuration for next start
+        self.saveConfig()
+        
+    def selectNetwork(self, command):
+        networkNb = command.networkNb
+        self.volumeController.drop()
+
+        if networkNb == 1 or networkNb == 2:
+            if self.player != "Sonos":
+                self.player = "Sonos"
+                self.logger.debug("Switching player to Sonos")
+                self.pi = self.si
+            if networkNb == 2:
+                self.changeNetwork("aagmr")
+            elif networkNb == 1:
+                self.changeNetwork("AP2")
+        elif networkNb == 3:
+            if self.player != "Mpd":
+                self.player = "Mpd"
+                self.logger.debug("Switching player to MPD")
+                self.pi = self.mi
+        else:
+            self.logger.error("Command NET {:d}: Network does not exist".format(networkNb))
+
+        self.logger.debug("Current Network: {}".format(self.network))
+        
+        # Save current configuration for next start
+        self.saveConfig()
+
     # Returns True in case the currently selected player is currently playing
     def isCurrentlyPlaying(self):
         return self.pi.isCurrentlyPlaying(self.room)
@@ -410,6 +497,7 @@ class PlayerInterfaceThread(threading.Thread):
         time.sleep(5)
         
         self.network = network
+        self.si.setNetwork(network)
         
 
 # Timer to trigger a shutdown after a given period of inactivity
@@ -528,19 +616,22 @@ def charliebert(logger, config):
     # Get configuration from config file if present
     loadConfig(logger, config)
     
-    # State indicator
-    stopper = threading.Event()
+    # State indicator (also waking up the lifecycle manager when set)
+    stopper = Stopper()
     # Queues for commands
     u2pQ = Q.Queue()
-    p2uQ = Q.Queue()
+    p2uQ = SignalingQueue()
     #
     shutdownPi = threading.Event()
     reset = threading.Event()
     startTime = "charliebert start: {}".format(datetime.now())
     logger.debug("{}".format(startTime))
     
+    # Created first: Its process must be started before any other thread (see MaintenanceWorker)
+    maintenanceWorker = MaintenanceWorker(logger, p2uQ)
+
     userInterfaceThread = UserInterfaceThread(stopper, u2pQ, p2uQ, reset, logger, config)
-    playerInterfaceThread = PlayerInterfaceThread(stopper, u2pQ, p2uQ, shutdownPi, logger, config)
+    playerInterfaceThread = PlayerInterfaceThread(stopper, u2pQ, p2uQ, shutdownPi, logger, config, maintenanceWorker)
 
     #shutdownTimerThread = ShutdownTimerThread(stopper, reset, shutdownPi, startTime, playerInterfaceThread, logger)
     shutdownTimerThread = ShutdownTimerThreadWorkaround(stopper, reset, shutdownPi, startTime, playerInterfaceThread, logger)
@@ -558,37 +649,35 @@ def charliebert(logger, config):
     if os.path.exists(switchFile):
         logger.debug("Removing switch file CHARLIEBERT_STOP")
         os.remove(switchFile)
-    
-            
-    try:
-        while not os.path.exists(switchFile) and not stopper.is_set():
-            pass
-        
-        if os.path.exists(switchFile):
-            logger.debug("Stop requested using the flag file '{}'".format(switchFile))
-            os.remove(switchFile)
-
-           
-    except KeyboardInterrupt:
-        logger.debug("Stop requested")
-        stopper.set() 
-        reset.set() 
-    
-    finally:
-        if not stopper.is_set():
-            stopper.set() 
-        if not reset.is_set():
-            reset.set() 
-            
-            
+
+    lifecycleManager = LifecycleManager(logger, stopper, switchFile)
+    lifecycleManager.installSignalHandlers()
+
+    def stopThreads():
+        stopper.set()
+        reset.set()
+
+    def stopPlayerInterface():
         while not u2pQ.empty():
             u2pQ.get()
         u2pQ.put(None)
-        
 
-        # Write configuration to disk when exiting the program
-        writeConfig(logger, config)
-        
+    # Shutdown steps, in order, with their time limit (s)
+    lifecycleManager.addShutdownStep("stop threads", stopThreads, 1)
+    lifecycleManager.addShutdownStep("stop player interface", stopPlayerInterface, 1)
+    lifecycleManager.addShutdownStep("join player interface", playerInterfaceThread.join, 15)
+    lifecycleManager.addShutdownStep("join user interface", userInterfaceThread.join, 5)
+    lifecycleManager.addShutdownStep("join shutdown timer", shutdownTimerThread.join, 2)
+    # Write configuration to disk when exiting the program
+    lifecycleManager.addShutdownStep("write config", lambda: writeConfig(logger, config), 5)
+
+    try:
+        reason = lifecycleManager.waitForStop()
+        logger.debug("Stop requested ({})".format(reason))
+    finally:
+        lifecycleManager.shutdown()
+        lifecycleManager.close()
+
     if shutdownPi.is_set():
         logger.debug("Shutting down Pi now")
         # Hack to work around the need for a password when using sudo:
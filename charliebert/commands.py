@@ -0,0 +1,134 @@
+try:
+    import Queue as Q # For python 2
+except:
+    import queue as Q # For python 3
+
+
+# Commands exchanged between the user interface and the player interface threads
+# (through the u2pQ and p2uQ queues). The receiving thread dispatches them on their type.
+class Command(object):
+    __slots__ = ()
+    # Name used in log messages
+    name = None
+
+    def __str__(self):
+        slots = [slot for cls in reversed(type(self).__mro__) for slot in getattr(cls, '__slots__', ())]
+        return ' '.join([self.name] + ['{}'.format(getattr(self, slot)) for slot in slots])
+
+
+# User interface -> player interface
+class PlayPause(Command):
+    __slots__ = ()
+    name = 'PLAY/PAUSE'
+
+
+class Forward(Command):
+    __slots__ = ()
+    name = 'FORWARD'
+
+
+class Back(Command):
+    __slots__ = ()
+    name = 'BACK'
+
+
+class StartPlaylist(Command):
+    __slots__ = ('bank', 'bankNb')
+    name = 'PLAYLIST'
+
+    def __init__(self, bank, bankNb):
+        self.bank = bank
+        self.bankNb = bankNb
+
+
+class StartAltPlaylist(StartPlaylist):
+    __slots__ = ()
+    name = 'ALTPLAYLIST'
+
+
+class PlayTrack(Command):
+    __slots__ = ('trackNb',)
+    name = 'TRACK'
+
+    def __init__(self, trackNb):
+        self.trackNb = trackNb
+
+
+class AdjustVolume(Command):
+    __slots__ = ('volumeDelta',)
+    name = 'VOLUME'
+
+    def __init__(self, volumeDelta):
+        self.volumeDelta = volumeDelta
+
+
+class Shutdown(Command):
+    __slots__ = ()
+    name = 'SHUTDOWN'
+
+
+# Maintenance command, selected with a playlist switch in shift mode
+class RunCommand(Command):
+    __slots__ = ('commandNb',)
+    name = 'COMMAND'
+
+    def __init__(self, commandNb):
+        self.commandNb = commandNb
+
+
+class SelectRoom(Command):
+    __slots__ = ('roomNb',)
+    name = 'ROOM'
+
+    def __init__(self, roomNb):
+        self.roomNb = roomNb
+
+
+class SelectNetwork(Command):
+    __slots__ = ('networkNb',)
+    name = 'NET'
+
+    def __init__(self, networkNb):
+        self.networkNb = networkNb
+
+
+# Player interface -> user interface
+class SetNetworkAndRoom(Command):
+    __slots__ = ('networkIndex', 'roomIndex')
+    name = 'NETWORK/ROOM'
+
+    def __init__(self, networkIndex, roomIndex):
+        self.networkIndex = networkIndex
+        self.roomIndex = roomIndex
+
+
+# Maintenance job running (active), with its progress in percent (None if unknown)
+class Progress(Command):
+    __slots__ = ('active', 'percent')
+    name = 'PROGRESS'
+
+    def __init__(self, active, percent=None):
+        self.active = active
+        self.percent = percent
+
+
+# Request to log the diagnostics of the user interface (I2C transaction statistics)
+class Diagnostics(Command):
+    __slots__ = ()
+    name = 'DIAGNOSTICS'
+
+
+# Queue of commands setting the events of its listeners whenever a command is put,
+# so that the receiving thread can sleep until there is something to do
+class SignalingQueue(Q.Queue):
+    def __init__(self, maxsize=0):
+        Q.Queue.__init__(self, maxsize)
+        self.listeners = []
+
+    def addListener(self, event):
+        self.listeners.append(event)
+
+    def put(self, item, block=True, timeout=None):
+        Q.Queue.put(self, item, block, timeout)
+        for event in self.listeners:
+            event.set()
@@ -2,11 +2,12 @@ import logging
 from logging.handlers import RotatingFileHandler
 from sonosInterface import SonosInterface
 from playerInterface import Playlist
+from smbConnectionPool import SmbConnectionPool
+from musicStore import MusicStore
 import subprocess
 import os
 import filecmp
 import json
-from shutil import copyfile
     
 from PIL import Image
 import numpy as np
@@ -193,18 +194,21 @@ class ExtractCovers():
             im_grid.paste(im, ((i % n_horiz) * maxLength + imageOffset[i][0], (i // n_vert) * maxLength + imageOffset[i][1]))
         return im_grid
     
-    def createPlaylistKey(self):
-        importPlaylists = True
-        extractCoverArt = True
-        removeFiles = True
-        
-        self.regeneratePlaylistImage = True
-        pdflatexPath = u'/opt/local/bin/pdflatex'
-        mp4artPath = u'/opt/local/bin/mp4art'
-        ffmpegPath = u'/usr/local/bin/ffmpeg'
+    # progress(fraction) is called after each playlist; 
+    # no further playlist is processed once cancel() returns True
+    def createPlaylistKey(self, progress=None, cancel=None):
+        logger = self.logger
+        pdflatexPath = self.pdflatexPath
+        mp4artPath = self.mp4artPath
+        ffmpegPath = self.ffmpegPath
             
         logger.info("Creating instance of SonosInterface") 
         si = SonosInterface(logger)
+        # SMB connections shared by all playlists
+        smbPool = SmbConnectionPool(logger)
+        # Music files shared with the MPD library: Tracks already in the store are only linked
+        store = MusicStore(u'store', logger)
+        store.beginSession()
         try:
             si.printSpeakerList()        
             
@@ -214,29 +218,24 @@ class ExtractCovers():
             #for bank in (u'A'):
                 for index in range(1,13):
                 #for index in range(1,2):
+                    if cancel is not None and cancel():
+                        logger.info("Creation of the playlist key canceled")
+                        return
+                    if progress is not None:
+                        progress(0.9 * ((ord(bank) - ord(u'A')) * 12 + index - 1) / 48)
+                        
                     playlistChanged = True
                     playlistName = u'{}{}{:02d}'.format(playlistBasename, bank, index)
                     if self.importPlaylists:
-                        try:                            
-                            logger.debug(u'Remove existing file {}_prev.json'.format(playlistName))
-                            os.remove(u'playlists/{}_prev.json'.format(playlistName))
-                        except:
-                            pass
-                            
-                        if os.path.isfile(u'playlists/{}.json'.format(playlistName)):                            
-                            logger.debug(u'Make a copy of existing file {}.json'.format(playlistName))
-                            copyfile(u'playlists/{}.json'.format(playlistName), u'playlists/{}_prev.json'.format(playlistName))
+                        previousHash = si.playlistStore.getSyncInfo(playlistName).get(u'hash')
                                 
                         si.exportPlaylistDetails(playlistName, 'Office', None, True)
                      
-                        try:
-                            if (filecmp.cmp(u'playlists/{}.json'.format(playlistName), u'playlists/{}_prev.json'.format(playlistName))):
-                                logger.debug(u'Playlist file identical to previous version (playlists/{}.json same as playlists/{}_prev.json)'.format(playlistName, playlistName))
-                                playlistChanged = False
-                            else:
-                                logger.debug(u'Playlist file not identical to previous version (playlists/{}.json differs from playlists/{}_prev.json)'.format(playlistName, playlistName))
-                        except:
-                            pass
+                        if previousHash is not None and si.playlistStore.getSyncInfo(playlistName).get(u'hash') == previousHash:
+                            logger.debug(u'Playlist {} identical to previous version'.format(playlistName))
+                            playlistChanged = False
+                        else:
+                            logger.debug(u'Playlist {} not identical to previous version'.format(playlistName))
                         
                         if playlistChanged or not os.path.isfile(u'playlists/{}.jpg'.format(playlistName)):
                             logger.debug(u'Playlist {} has changed and/or playlist image not present: Regenerating'.format(playlistName))
@@ -246,16 +245,13 @@ class ExtractCovers():
                             
                         if playlistChanged:
                             try:
-                                logger.debug("Define Playlist object")
-                                playlist = Playlist(playlistName)                        
-            
-                                logger.debug("Read JSON")
-                                playlist.readFromFile(u'playlists/{}.json'.format(playlistName))
+                                playlist = si.playlistStore.getPlaylist(playlistName)
                                   
                                 logger.debug(u'Playlist {}'.format(playlist.name))
                                       
                                 logger.debug("Copying files")
-                                playlist.copyFiles(u'playlists/{}'.format(playlistName), u'toma', u'', True, True, logger)
+                                playlist.copyFiles(u'playlists/{}'.format(playlistName), u'toma', u'', True, True, logger, smbPool, 
+                                                   store=store, uriIndex=si.uriIndex)
                             except:
                                 logger.error("Error while importing playlist '{}'".format(playlistName))    
                     
@@ -374,6 +370,10 @@ class ExtractCovers():
         except KeyboardInterrupt:
             logger.info("Stop (Ctrl-C from __main__)") 
             print("Stop (Ctrl-C) [from main]")
+        finally:
+            # Also on errors: The files fetched so far stay referenced by the store index
+            store.endSession()
+            smbPool.closeAll()
                             
 
 if __name__ == '__main__':
@@ -0,0 +1,243 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Token bucket shared by concurrent transfers, capping their overall bandwidth
+# (so that copying files does not make the playback over wifi stutter)
+class BandwidthLimiter:
+    def __init__(self, bytesPerSecond, burst=None):
+        self.rate = float(bytesPerSecond)
+        # Maximum number of bytes which can be transferred at once after an idle period
+        self.capacity = float(burst if burst is not None else bytesPerSecond)
+        self.tokens = self.capacity
+        self.lastTime = time.time()
+        self.lock = threading.Lock()
+
+    # Account for nbBytes transferred, waiting as long as needed to stay below the rate
+    def consume(self, nbBytes):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.lastTime) * self.rate)
+            self.lastTime = now
+            # Tokens may become negative: The transfer then waits until the debt is paid off
+            self.tokens -= nbBytes
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+# File object whose writes are throttled by a BandwidthLimiter
+class ThrottledFile:
+    def __init__(self, fp, limiter):
+        self.fp = fp
+        self.limiter = limiter
+
+    def write(self, data):
+        self.limiter.consume(len(data))
+        return self.fp.write(data)
+
+
+# File object computing the SHA-1 checksum of the data while it is written
+class HashingFile:
+    def __init__(self, fp, checksum=None):
+        self.fp = fp
+        self.checksum = checksum if checksum is not None else hashlib.sha1()
+
+    def write(self, data):
+        self.checksum.update(data)
+        return self.fp.write(data)
+
+    def hexdigest(self):
+        return self.checksum.hexdigest()
+
+
+# Download a file through an SMB connection into target. 
+# The data goes to target.part first, which is renamed to target only once complete,
+# so that an interrupted transfer never leaves a truncated target behind. If a partial
+# file is left over from a previous attempt of the same remote file (same size and
+# modification time, recorded in target.part.meta), only the missing bytes are retrieved.
+# remoteAttributes: (size, mtime) of the remote file, if already known.
+# Returns the SHA-1 checksum of the file
+def downloadFile(conn, share, path, target, limiter=None, logger=None, blockSize=65536, remoteAttributes=None):
+    partFile = u'{}.part'.format(target)
+    metaFile = u'{}.part.meta'.format(target)
+    if remoteAttributes is None:
+        attributes = conn.getAttributes(share, path)
+        remoteAttributes = (attributes.file_size, int(attributes.last_write_time))
+    remoteSize = remoteAttributes[0]
+    
+    # Resume from the data already retrieved (its checksum is computed while reading it once)
+    checksum = hashlib.sha1()
+    offset = 0
+    if os.path.isfile(partFile):
+        try:
+            with open(metaFile, 'r') as fp:
+                partAttributes = tuple(json.load(fp))
+        except (IOError, ValueError, TypeError):
+            partAttributes = None
+            
+        if partAttributes == tuple(remoteAttributes) and os.path.getsize(partFile) <= remoteSize:
+            with open(partFile, 'rb') as fp:
+                for block in iter(lambda: fp.read(blockSize), b''):
+                    checksum.update(block)
+                    offset += len(block)
+            if logger is not None and offset > 0:
+                logger.debug(u'Resuming download of {} at {:d}/{:d} bytes'.format(target, offset, remoteSize))
+        else:
+            # The remote file was replaced since (or unknown origin): Start over
+            if logger is not None:
+                logger.debug(u'Discarding partial download of {}: Remote file changed'.format(target))
+            os.remove(partFile)
+            
+    if offset == 0:
+        with open(metaFile, 'w') as fp:
+            json.dump(list(remoteAttributes), fp)
+        
+    with open(partFile, 'ab') as fp:
+        out = HashingFile(fp, checksum)
+        if offset < remoteSize:
+            if limiter is not None:
+                conn.retrieveFileFromOffset(share, path, ThrottledFile(out, limiter), offset)
+            else:
+                conn.retrieveFileFromOffset(share, path, out, offset)
+    
+    size = os.path.getsize(partFile)
+    if size != remoteSize:
+        raise IOError(u'Incomplete download of {}: {:d} of {:d} bytes'.format(target, size, remoteSize))
+    
+    os.rename(partFile, target)
+    os.remove(metaFile)
+    return out.hexdigest()
+
+
+# Exclusive lock on a file shared by several processes (e.g. the player and the maintenance job)
+@contextmanager
+def lockFile(path):
+    with open(path, 'a') as fp:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+# Size and modification time of the files in a remote directory {file name: (size, mtime)}
+def listRemoteAttributes(conn, share, directory):
+    attributes = {}
+    for f in conn.listPath(share, directory if directory else u'/'):
+        if not f.isDirectory:
+            attributes[f.filename] = (f.file_size, int(f.last_write_time))
+    return attributes
+
+
+# Remote size and modification time of the files at the time they were downloaded, 
+# keyed by URI, to tell which files have changed since. Several processes may use the same
+# manifest: Changes are merged into the file when saving
+class TransferManifest:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = self.read()
+        # Changes not saved yet {uri: attributes, or None if removed}
+        self.changes = {}
+
+    def read(self):
+        try:
+            with open(self.path, 'r') as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+    def matches(self, uri, attributes):
+        with self.lock:
+            entry = self.entries.get(uri)
+        return entry is not None and tuple(entry) == tuple(attributes)
+
+    def update(self, uri, attributes):
+        with self.lock:
+            self.entries[uri] = list(attributes)
+            self.changes[uri] = list(attributes)
+
+    def remove(self, uris):
+        with self.lock:
+            for uri in uris:
+                self.entries.pop(uri, None)
+                self.changes[uri] = None
+
+    def save(self):
+        with self.lock:
+            if not self.changes:
+                return
+            changes = self.changes
+            self.changes = {}
+            
+        with lockFile(u'{}.lock'.format(self.path)):
+            entries = self.read()
+            for uri, entry in changes.items():
+                if entry is None:
+                    entries.pop(uri, None)
+                else:
+                    entries[uri] = entry
+            tmpFile = u'{}.tmp'.format(self.path)
+            with open(tmpFile, 'w') as fp:
+                json.dump(entries, fp, indent=2, sort_keys=True)
+            os.rename(tmpFile, self.path)
+            
+        with self.lock:
+            # Keep the changes made meanwhile
+            for uri, entry in self.changes.items():
+                if entry is None:
+                    entries.pop(uri, None)
+                else:
+                    entries[uri] = entry
+            self.entries = entries
+
+
+# Outcome of copying a set of files
+class CopyResult:
+    def __init__(self):
+        self.copied = []
+        self.skipped = []
+        # Files taken from the music store, without any transfer
+        self.linked = []
+        # [(file, error message), ...]
+        self.failed = []
+        # SHA-1 checksums of the copied files {file: checksum}
+        self.checksums = {}
+        self.lock = threading.Lock()
+
+    def addCopied(self, target, checksum=None):
+        with self.lock:
+            self.copied.append(target)
+            if checksum is not None:
+                self.checksums[target] = checksum
+
+    def addSkipped(self, target):
+        with self.lock:
+            self.skipped.append(target)
+
+    def addLinked(self, target):
+        with self.lock:
+            self.linked.append(target)
+
+    def addFailed(self, target, error):
+        with self.lock:
+            self.failed.append((target, u'{}'.format(error)))
+
+    def merge(self, other):
+        with self.lock:
+            self.copied.extend(other.copied)
+            self.skipped.extend(other.skipped)
+            self.linked.extend(other.linked)
+            self.failed.extend(other.failed)
+            self.checksums.update(other.checksums)
+
+    def __str__(self):
+        return '{:d} copied, {:d} linked, {:d} skipped, {:d} failed'.format(len(self.copied), len(self.linked), 
+                                                                          len(self.skipped), len(self.failed))
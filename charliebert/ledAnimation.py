@@ -0,0 +1,164 @@
+import time
+
+
+# Leds to be set for one frame of an animation (None: Leave the leds alone)
+class Frame(object):
+    __slots__ = ('bankLeds', 'speakerLeds')
+
+    def __init__(self, bankLeds=None, speakerLeds=None):
+        # [True/False for each bank led]
+        self.bankLeds = bankLeds
+        # Code for the speaker leds (MCP port A)
+        self.speakerLeds = speakerLeds
+
+
+# Led pattern, changing every period seconds. Frame frameNb is shown from startTime + frameNb * period on;
+# onStart/onStop are called when the animation starts/stops (e.g. to restore the leds),
+# onFrame after each frame is shown
+class Pattern(object):
+    def __init__(self, name, period, onStart=None, onStop=None, onFrame=None):
+        self.name = name
+        self.period = period
+        self.onStart = onStart
+        self.onStop = onStop
+        self.onFrame = onFrame
+
+    def getFrame(self, frameNb):
+        raise NotImplementedError()
+
+
+# All bank leds on and off alternately
+class BlinkAll(Pattern):
+    def __init__(self, name, period, nbLeds, **callbacks):
+        super(BlinkAll, self).__init__(name, period, **callbacks)
+        self.nbLeds = nbLeds
+
+    def getFrame(self, frameNb):
+        return Frame(bankLeds=[frameNb % 2 == 0] * self.nbLeds)
+
+
+# One bank led (given by getIndex()) off and on alternately, the others off
+class BlinkOne(Pattern):
+    def __init__(self, name, period, nbLeds, getIndex, **callbacks):
+        super(BlinkOne, self).__init__(name, period, **callbacks)
+        self.nbLeds = nbLeds
+        self.getIndex = getIndex
+
+    def getFrame(self, frameNb):
+        index = self.getIndex() if frameNb % 2 == 1 else None
+        return Frame(bankLeds=[i == index for i in range(self.nbLeds)])
+
+
+# Speaker leds switched on one after the other
+class Cycle(Pattern):
+    def __init__(self, name, period, codes, **callbacks):
+        super(Cycle, self).__init__(name, period, **callbacks)
+        self.codes = codes
+
+    def getFrame(self, frameNb):
+        return Frame(speakerLeds=self.codes[frameNb % len(self.codes)])
+
+
+# Speaker leds switched on in turn as the progress (in percent, from getPercent()) increases,
+# the next one blinking; cycling through them while the progress is unknown
+class ProgressBar(Cycle):
+    def __init__(self, name, period, codes, getPercent, **callbacks):
+        super(ProgressBar, self).__init__(name, period, codes, **callbacks)
+        self.getPercent = getPercent
+
+    def getFrame(self, frameNb):
+        percent = self.getPercent()
+        if percent is None:
+            return super(ProgressBar, self).getFrame(frameNb)
+
+        nbOn = min(len(self.codes), max(0, int(percent)) * len(self.codes) // 100)
+        code = 0
+        for c in self.codes[:nbOn]:
+            code |= c
+        if nbOn < len(self.codes) and frameNb % 2 == 0:
+            code |= self.codes[nbOn]
+        return Frame(speakerLeds=code)
+
+
+# Runs the active patterns: Each one is rendered when its next frame is due (computed from its start
+# time, so that the timing does not drift), the leds of all the patterns due being written once per frame
+# with writeBankLeds(states) and writeSpeakerLeds(code)
+class LedAnimation:
+    def __init__(self, logger, writeBankLeds, writeSpeakerLeds):
+        self.logger = logger
+        self.writeBankLeds = writeBankLeds
+        self.writeSpeakerLeds = writeSpeakerLeds
+
+        # {name: [pattern, startTime, last frame shown]}
+        self.active = {}
+        self.nbFrames = 0
+
+    def isActive(self, name):
+        return name in self.active
+
+    def start(self, pattern):
+        if pattern.name in self.active:
+            return
+        self.logger.debug("Starting led animation '{}'".format(pattern.name))
+        if pattern.onStart is not None:
+            pattern.onStart()
+        self.active[pattern.name] = [pattern, time.time(), None]
+
+    def stop(self, name):
+        entry = self.active.pop(name, None)
+        if entry is None:
+            return
+        self.logger.debug("Stopping led animation '{}'".format(name))
+        if entry[0].onStop is not None:
+            entry[0].onStop()
+
+    # Start or stop the animation depending on the condition
+    def setActive(self, pattern, active):
+        if active:
+            self.start(pattern)
+        else:
+            self.stop(pattern.name)
+
+    # Time (s) until the next frame is due (None if no animation is active)
+    def getTimeout(self):
+        if not self.active:
+            return None
+        now = time.time()
+        timeout = None
+        for (pattern, startTime, frameNb) in self.active.values():
+            if frameNb is None:
+                return 0
+            due = startTime + (frameNb + 1) * pattern.period - now
+            timeout = due if timeout is None else min(timeout, due)
+        return max(0, timeout)
+
+    # Show the frames which are due
+    def update(self):
+        now = time.time()
+        frames = []
+        for entry in self.active.values():
+            (pattern, startTime, lastFrameNb) = entry
+            frameNb = int((now - startTime) / pattern.period)
+            if frameNb == lastFrameNb:
+                continue
+            entry[2] = frameNb
+            frames.append((pattern, pattern.getFrame(frameNb)))
+        if not frames:
+            return
+
+        bankLeds = None
+        speakerLeds = None
+        for (pattern, frame) in frames:
+            if frame.bankLeds is not None:
+                bankLeds = frame.bankLeds
+            if frame.speakerLeds is not None:
+                speakerLeds = frame.speakerLeds
+        if bankLeds is not None:
+            self.writeBankLeds(bankLeds)
+        if speakerLeds is not None:
+            self.writeSpeakerLeds(speakerLeds)
+        self.nbFrames += 1
+
+        for (pattern, frame) in frames:
+            if pattern.onFrame is not None:
+                pattern.onFrame()
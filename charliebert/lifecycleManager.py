@@ -0,0 +1,194 @@
+import os
+import errno
+import fcntl
+import select
+import signal
+import struct
+import threading
+import time
+import ctypes
+import ctypes.util
+
+try:
+    EventBase = threading._Event # For python 2 (threading.Event is a factory function)
+except AttributeError:
+    EventBase = threading.Event # For python 3
+
+
+# Stop flag shared by all threads which, once set, also wakes up whoever waits
+# for its file descriptor with select (self-pipe)
+class Stopper(EventBase):
+    def __init__(self):
+        EventBase.__init__(self)
+        # Events set together with the stopper (waking up threads waiting for them)
+        self.linkedEvents = []
+        self.readFd, self.writeFd = os.pipe()
+        for fd in (self.readFd, self.writeFd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def link(self, event):
+        self.linkedEvents.append(event)
+        if self.is_set():
+            event.set()
+
+    def set(self):
+        EventBase.set(self)
+        for event in self.linkedEvents:
+            event.set()
+        writeFd = self.writeFd
+        if writeFd is None:
+            # Closed: Nobody waits for the pipe any more
+            return
+        try:
+            os.write(writeFd, b'x')
+        except OSError:
+            # Pipe full: A wake-up is pending anyway
+            pass
+
+    def fileno(self):
+        return self.readFd
+
+    # Release the pipe (the stop flag itself remains usable)
+    def close(self):
+        readFd, writeFd = self.readFd, self.writeFd
+        self.readFd, self.writeFd = None, None
+        for fd in (readFd, writeFd):
+            if fd is not None:
+                os.close(fd)
+
+
+# Notification of the creation of a file in a directory through inotify (Linux only)
+class FileCreationWatch:
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    IN_CREATE = 0x00000100
+    IN_MOVED_TO = 0x00000080
+
+    def __init__(self, directory):
+        libcName = ctypes.util.find_library('c')
+        if libcName is None:
+            raise OSError(u'libc not found')
+        libc = ctypes.CDLL(libcName, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(u'inotify not available')
+
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), u'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, directory.encode('utf8'), self.IN_CREATE | self.IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, u'inotify_add_watch failed for {}'.format(directory))
+
+    # Names of the files created since the last call
+    def readCreatedFiles(self):
+        names = []
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            offset = 0
+            while offset + 16 <= len(data):
+                (wd, mask, cookie, length) = struct.unpack_from('iIII', data, offset)
+                names.append(data[offset + 16:offset + 16 + length].rstrip(b'\0').decode('utf8', 'ignore'))
+                offset += 16 + length
+        return names
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Waits (without using the CPU) until a stop is requested: stopper set by a thread,
+# SIGTERM/SIGINT received, or switch file created (watched with inotify, or checked
+# every pollPeriod seconds if inotify is not available). Then runs the shutdown steps
+# in order, each one within a time limit.
+class LifecycleManager:
+    def __init__(self, logger, stopper, switchFile=u'CHARLIEBERT_STOP', pollPeriod=1.0):
+        self.logger = logger
+        self.stopper = stopper
+        self.switchFile = switchFile
+        self.pollPeriod = pollPeriod
+
+        # [(name, function, timeout), ...]
+        self.shutdownSteps = []
+        self.signalReceived = None
+
+        self.watch = None
+        try:
+            self.watch = FileCreationWatch(os.path.dirname(os.path.abspath(self.switchFile)))
+        except OSError as e:
+            self.logger.debug(u'Cannot watch switch file with inotify ({}): Polling instead'.format(e))
+
+    def installSignalHandlers(self):
+        for signalNb in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signalNb, self.handleSignal)
+
+    def handleSignal(self, signalNb, frame):
+        self.signalReceived = signalNb
+        self.stopper.set()
+
+    def switchFileExists(self):
+        return os.path.exists(self.switchFile)
+
+    # Block until a stop is requested; returns the reason
+    def waitForStop(self):
+        fds = [self.stopper] + ([self.watch] if self.watch is not None else [])
+        timeout = None if self.watch is not None else self.pollPeriod
+        while True:
+            if self.signalReceived is not None:
+                return u'signal {:d}'.format(self.signalReceived)
+            if self.stopper.is_set():
+                return u'stopper'
+            if self.switchFileExists():
+                self.logger.debug("Stop requested using the flag file '{}'".format(self.switchFile))
+                try:
+                    os.remove(self.switchFile)
+                except OSError:
+                    pass
+                return u'switch file'
+
+            try:
+                readable, _, _ = select.select(fds, [], [], timeout)
+            except (select.error, OSError) as e:
+                # Interrupted by a signal: Check the flags again
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.watch is not None and self.watch in readable:
+                self.watch.readCreatedFiles()
+
+    def addShutdownStep(self, name, function, timeout):
+        self.shutdownSteps.append((name, function, timeout))
+
+    # Run the shutdown steps in order; a step not done within its timeout is left behind
+    def shutdown(self):
+        for (name, function, timeout) in self.shutdownSteps:
+            self.logger.debug(u'Shutdown: {}'.format(name))
+            startTime = time.time()
+            step = threading.Thread(target=self.runStep, name=u'Shutdown {}'.format(name), args=(name, function))
+            step.daemon = True
+            step.start()
+            step.join(timeout)
+            if step.is_alive():
+                self.logger.error(u'Shutdown: {} not complete after {} s: Going on'.format(name, timeout))
+            else:
+                self.logger.debug(u'Shutdown: {} done ({:.1f} s)'.format(name, time.time() - startTime))
+
+    def runStep(self, name, function):
+        try:
+            function()
+        except Exception as e:
+            self.logger.error(u'Shutdown: Problem during {}: {}'.format(name, e))
+
+    # Release the file descriptors, once the shutdown steps have run
+    def close(self):
+        if self.watch is not None:
+            self.watch.close()
+            self.watch = None
+        self.stopper.close()
@@ -0,0 +1,211 @@
+import logging
+import multiprocessing
+import threading
+import time
+try:
+    import Queue as Q # For python 2
+except:
+    import queue as Q # For python 3
+from commands import Progress
+from sonosInterface import SonosInterface
+from mpdInterface import MpdInterface
+from extractCovers import ExtractCovers
+
+
+# Runs long maintenance jobs (playlist sync, playlist key) in a separate process, one at a time,
+# so that the player thread keeps processing the playback commands meanwhile.
+# The job reports its progress, forwarded to the user interface as Progress commands, and
+# checks regularly whether it has been canceled. Its log records are forwarded to the logger
+# of this process (a single process writes the log file).
+#
+# The job process is started once, when the worker is created, and then runs the jobs it receives
+# (function and arguments, pickled). Forking a process while other threads hold locks (logging,
+# player interfaces, sqlite) could deadlock it: Python 3 spawns a fresh interpreter, Python 2
+# (fork only) requires the worker to be created before any other thread is started.
+class MaintenanceWorker:
+    def __init__(self, logger, p2uQ):
+        self.logger = logger
+        self.p2uQ = p2uQ
+
+        try:
+            context = multiprocessing.get_context('spawn') # For python 3
+        except AttributeError:
+            context = multiprocessing # For python 2
+        self.jobs = context.Queue()
+        self.messages = context.Queue()
+        self.cancelRequested = context.Event()
+        self.process = context.Process(target=runJobs, name="MaintenanceWorker",
+                                       args=(self.jobs, self.messages, self.cancelRequested))
+        self.process.daemon = True
+        self.process.start()
+
+        # Name of the running job (None if idle)
+        self.jobName = None
+        self.lock = threading.Lock()
+        # Time (s) to wait for the job process when stopping
+        self.stopTimeout = 10.0
+
+        self.forwarder = threading.Thread(target=self.forwardMessages, name="MaintenanceProgress")
+        self.forwarder.daemon = True
+        self.forwarder.start()
+
+    def isBusy(self):
+        return self.jobName is not None
+
+    # Run function(progress, cancel, logger, *args) in the job process; returns False if a job is already running.
+    # progress(fraction) reports the progress (between 0 and 1), cancel() returns True once canceled.
+    # function must be defined at module level and the arguments picklable
+    def start(self, jobName, function, *args):
+        with self.lock:
+            if self.jobName is not None:
+                self.logger.error("Maintenance job '{}' still running: Not starting '{}'".format(self.jobName, jobName))
+                return False
+            self.jobName = jobName
+
+        self.logger.debug("Starting maintenance job '{}'".format(jobName))
+        self.cancelRequested.clear()
+        self.p2uQ.put(Progress(True, 0))
+        self.jobs.put((jobName, function, args))
+        return True
+
+    # Forward the progress and log records of the jobs until the job process ends
+    def forwardMessages(self):
+        percent = 0
+        while True:
+            try:
+                (kind, value) = self.messages.get(timeout=1.0)
+            except Q.Empty:
+                if not self.process.is_alive():
+                    break
+                continue
+            except (EOFError, IOError):
+                break
+
+            if kind == 'log':
+                (level, message) = value
+                self.logger.log(level, "[{}] {}".format(self.jobName, message))
+            elif kind == 'progress':
+                if value != percent:
+                    percent = value
+                    self.p2uQ.put(Progress(True, percent))
+            elif kind == 'done':
+                self.logger.debug("Maintenance job '{}' {}".format(self.jobName, "complete" if value else "canceled or failed"))
+                self.p2uQ.put(Progress(False, percent))
+                percent = 0
+                with self.lock:
+                    self.jobName = None
+            elif kind == 'exit':
+                break
+
+        with self.lock:
+            if self.jobName is not None:
+                self.logger.error("Maintenance process ended while running '{}'".format(self.jobName))
+                self.p2uQ.put(Progress(False, percent))
+                self.jobName = None
+
+    # Ask the running job to stop (without waiting for it: it reports when done)
+    def cancel(self):
+        if not self.isBusy():
+            return
+
+        self.logger.debug("Canceling maintenance job '{}'".format(self.jobName))
+        self.cancelRequested.set()
+
+    def stop(self):
+        self.cancel()
+        self.jobs.put(None)
+        self.forwarder.join(self.stopTimeout)
+        self.process.join(1.0)
+        if self.process.is_alive():
+            # The queues are no longer used at this point
+            self.logger.error("Maintenance job '{}' did not stop: Terminating the process".format(self.jobName))
+            self.process.terminate()
+            self.process.join()
+
+
+# Log handler of the job process, sending the records to the worker
+class MessageHandler(logging.Handler):
+    def __init__(self, messages):
+        logging.Handler.__init__(self)
+        self.messages = messages
+
+    def emit(self, record):
+        try:
+            self.messages.put(('log', (record.levelno, self.format(record))))
+        except:
+            self.handleError(record)
+
+
+# Entry point of the job process: Run the jobs until None is received
+def runJobs(jobs, messages, cancelRequested):
+    logger = logging.getLogger('maintenance')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(MessageHandler(messages))
+    for name in ("soco", "requests", "urllib3"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    def progress(fraction):
+        messages.put(('progress', int(100 * max(0.0, min(1.0, fraction)))))
+
+    def cancel():
+        return cancelRequested.is_set()
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+
+        (jobName, function, args) = job
+        success = False
+        try:
+            function(progress, cancel, logger, *args)
+            success = not cancelRequested.is_set()
+        except Exception as e:
+            logger.error("Maintenance job '{}' failed: {}".format(jobName, e))
+        finally:
+            messages.put(('done', success))
+    messages.put(('exit', None))
+
+
+# Restrict the progress reported by a step of a job to [start, end]
+def subProgress(progress, start, end):
+    if progress is None:
+        return None
+    return lambda fraction: progress(start + (end - start) * fraction)
+
+
+# Jobs, creating their own player interfaces (connections are not shared with the parent process)
+def testProgressJob(progress, cancel, logger, duration=10):
+    for second in range(duration):
+        if cancel():
+            return
+        time.sleep(1)
+        progress(float(second + 1) / duration)
+
+
+def createPlaylistKeyJob(progress, cancel, logger, settings):
+    extractCovers = ExtractCovers(logger)
+    for name, value in settings.items():
+        setattr(extractCovers, name, value)
+    extractCovers.createPlaylistKey(progress, cancel)
+
+
+# Export the Sonos playlists, then import them into MPD
+def importPlaylistsJob(progress, cancel, logger, network, mpdSocket, copySettings, renewPlaylists, overwriteFiles):
+    si = SonosInterface(logger)
+    si.setNetwork(network)
+    mi = MpdInterface(logger, socketPath=mpdSocket, **copySettings)
+    try:
+        logger.debug("Exporting sonos playlists...")
+        si.exportAllPlaylists(u'Office', renewPlaylists, progress=subProgress(progress, 0.0, 0.2), cancel=cancel)
+        logger.debug("Done.")
+        if cancel():
+            return
+
+        logger.debug("Importing playlists into MPD...")
+        mi.importAllPlaylists(u'Office', overwriteFiles, progress=subProgress(progress, 0.2, 1.0), cancel=cancel)
+        logger.debug("Done.")
+    finally:
+        si.close()
+        mi.close()
@@ -0,0 +1,108 @@
+import threading
+import time
+
+
+# Access to the registers of an MCP23017 port expander (IOCON.BANK = 0, sequential operation enabled):
+# - The output latches (OLATA/OLATB) are shadowed, so that writing the value they already hold
+#   costs no I2C transaction
+# - Consecutive registers can be read in a single block transaction
+# - Transactions are counted per register, with their latency (see getStats)
+class Mcp23017:
+    registers = {
+        'IODIRA': 0x00, 'IODIRB': 0x01, 'IPOLA': 0x02, 'IPOLB': 0x03,
+        'GPINTENA': 0x04, 'GPINTENB': 0x05, 'DEFVALA': 0x06, 'DEFVALB': 0x07,
+        'INTCONA': 0x08, 'INTCONB': 0x09, 'IOCON': 0x0a,
+        'GPPUA': 0x0c, 'GPPUB': 0x0d, 'INTFA': 0x0e, 'INTFB': 0x0f,
+        'INTCAPA': 0x10, 'INTCAPB': 0x11, 'GPIOA': 0x12, 'GPIOB': 0x13,
+        'OLATA': 0x14, 'OLATB': 0x15}
+    registerNames = dict((address, name) for name, address in registers.items())
+    # IOCON is mapped to both addresses
+    registerNames[0x0b] = 'IOCON'
+    # Writing GPIOx sets the output latch OLATx
+    latches = {'GPIOA': 'OLATA', 'GPIOB': 'OLATB', 'OLATA': 'OLATA', 'OLATB': 'OLATB'}
+
+    def __init__(self, bus, address=0x20, logger=None):
+        self.bus = bus
+        self.address = address
+        self.logger = logger
+        # Transactions from the interrupt callbacks and the main loop
+        self.lock = threading.Lock()
+
+        # {latch: value} (unknown until written)
+        self.shadow = {}
+
+        # Statistics: {register: [reads, writes, skipped writes, total latency (s), max latency (s)]}
+        self.stats = dict((name, [0, 0, 0, 0.0, 0.0]) for name in self.registers)
+        self.nbBlockReads = 0
+
+    def getAddress(self, reg):
+        if reg not in self.registers:
+            raise ValueError("Unknown MCP23017 register '{}'".format(reg))
+        return self.registers[reg]
+
+    def read(self, reg):
+        address = self.getAddress(reg)
+        with self.lock:
+            startTime = time.time()
+            value = self.bus.read_byte_data(self.address, address)
+            self.count(reg, 0, time.time() - startTime)
+        return value
+
+    # Read nb consecutive registers starting with reg in a single transaction
+    def readBlock(self, reg, nb):
+        address = self.getAddress(reg)
+        if nb < 1 or address + nb > len(self.registerNames):
+            raise ValueError("Cannot read {:d} registers from '{}'".format(nb, reg))
+        with self.lock:
+            startTime = time.time()
+            values = self.bus.read_i2c_block_data(self.address, address, nb)
+            latency = time.time() - startTime
+            self.nbBlockReads += 1
+            for offset in range(nb):
+                self.count(self.registerNames[address + offset], 0, latency / nb)
+        return values
+
+    # Read both ports of a register pair (e.g. GPIOA and GPIOB): (port A, port B)
+    def readPair(self, reg):
+        (valueA, valueB) = self.readBlock(reg[:-1] + 'A', 2)
+        return (valueA, valueB)
+
+    # Write a register; returns False if skipped (output latch already holding the value)
+    def write(self, reg, value, force=False):
+        address = self.getAddress(reg)
+        latch = self.latches.get(reg)
+        with self.lock:
+            if not force and latch is not None and self.shadow.get(latch) == value:
+                self.stats[reg][2] += 1
+                return False
+            startTime = time.time()
+            try:
+                self.bus.write_byte_data(self.address, address, value)
+            except:
+                # State of the latch unknown
+                if latch is not None:
+                    self.shadow.pop(latch, None)
+                raise
+            self.count(reg, 1, time.time() - startTime)
+            if latch is not None:
+                self.shadow[latch] = value
+        return True
+
+    def count(self, reg, kind, latency):
+        stats = self.stats[reg]
+        stats[kind] += 1
+        stats[3] += latency
+        stats[4] = max(stats[4], latency)
+
+    # Statistics of the registers used so far, one line per register
+    def getStats(self):
+        lines = []
+        with self.lock:
+            for reg in sorted(self.stats, key=lambda name: self.registers[name]):
+                (reads, writes, skipped, totalLatency, maxLatency) = self.stats[reg]
+                if reads + writes + skipped == 0:
+                    continue
+                lines.append("{}: {:d} reads, {:d} writes, {:d} skipped writes, latency {:.2f} ms avg. / {:.2f} ms max.".format(
+                             reg, reads, writes, skipped, 1000 * totalLatency / max(1, reads + writes), 1000 * maxLatency))
+            lines.append("{:d} block reads".format(self.nbBlockReads))
+        return lines
@@ -1,16 +1,244 @@
 from playerInterface import PlayerInterface
 from mpd import MPDClient
+from mpd import ConnectionError as MpdConnectionError
+from mpd import CommandError as MpdCommandError
 import logging
 from logging.handlers import RotatingFileHandler
 from time import sleep
 import time
-from cookielib import logger
+import threading
+import socket
+import select
 from playerInterface import Playlist
+from playlistStore import PlaylistStore
+from uriIndex import UriIndex
+from smbConnectionPool import SmbConnectionPool
+from fileTransfer import BandwidthLimiter, CopyResult
+from musicStore import MusicStore
 import os
 import re
 
+
+# Long-lived connection to the MPD server, shared by all the commands of an MpdInterface.
+# Commands are forwarded to the underlying MPDClient; if the connection turns out to be 
+# dead (server restarted, idle connection closed by MPD, ...), it is transparently 
+# re-established and the command is sent once more.
+class MpdConnection:
+    def __init__(self, logger, host=u'localhost', port=6600, socketPath=None, timeout=10):
+        self.logger = logger
+        
+        # Connection parameters (the UNIX socket, if defined, takes precedence over host/port)
+        self.host = host
+        self.port = port
+        self.socketPath = socketPath
+        
+        self.client = MPDClient()
+        self.client.timeout = timeout
+        
+        self.connected = False
+        
+        # Several threads (player, shutdown timer) share the same connection
+        self.lock = threading.RLock()
+        
+        # Position of the failing command within a command list, from an MPD error
+        self.ackParser = re.compile(u'\\[\\d+@(\\d+)\\]')
+        
+    def connect(self):
+        with self.lock:
+            if self.connected:
+                return
+            
+            if self.socketPath is not None:
+                self.logger.debug(u'Connecting to MPD via UNIX socket {}'.format(self.socketPath))
+                self.client.connect(self.socketPath)
+            else:
+                self.logger.debug(u'Connecting to MPD at {}:{:d}'.format(self.host, self.port))
+                self.client.connect(self.host, self.port)
+            self.connected = True
+    
+    def disconnect(self):
+        with self.lock:
+            try:
+                self.client.close()
+            except:
+                pass
+            try:
+                self.client.disconnect()
+            except:
+                pass
+            self.connected = False
+    
+    def reconnect(self):
+        with self.lock:
+            self.logger.debug(u'Re-establishing connection to MPD')
+            self.disconnect()
+            self.connect()
+
+    # Returns True in case the server answers a ping
+    def isAlive(self):
+        with self.lock:
+            if not self.connected:
+                return False
+            try:
+                self.client.ping()
+                return True
+            except (MpdConnectionError, socket.error):
+                self.disconnect()
+                return False
+
+    # Run a function using the client, retrying once on a fresh connection if the current one is dead
+    def execute(self, function):
+        with self.lock:
+            self.connect()
+            try:
+                return function(self.client)
+            except (MpdConnectionError, socket.error) as e:
+                self.logger.debug(u'Connection to MPD lost ({}): Retrying'.format(e))
+                self.reconnect()
+                return function(self.client)
+    
+    # Send a list of commands [(name, args), ...] as MPD command_list batches.
+    # Returns a list with one entry per command: its result, or the CommandError MPD answered with.
+    # MPD aborts a batch at the first failing command; the remaining commands are then sent 
+    # in a new batch, so the number of round trips is 1 + number of failing commands.
+    def executeCommandList(self, commands):
+        results = [None] * len(commands)
+        start = 0
+        
+        def sendBatch(client):
+            client.command_list_ok_begin()
+            for name, args in commands[start:]:
+                getattr(client, name)(*args)
+            return client.command_list_end()
+        
+        with self.lock:
+            while start < len(commands):
+                try:
+                    batchResults = self.execute(sendBatch)
+                    results[start:start + len(batchResults)] = batchResults
+                    break
+                except MpdCommandError as e:
+                    # Error messages look like "[50@3] {rm} No such playlist"
+                    m = self.ackParser.search(u'{}'.format(e))
+                    if m is None:
+                        raise
+                    failedIndex = start + int(m.group(1))
+                    results[failedIndex] = e
+                    start = failedIndex + 1
+        
+        return results
+    
+    def __getattr__(self, name):
+        # Forward MPD commands (status, play, setvol, ...) to the client
+        if name.startswith('_') or name in ('client', 'lock', 'logger', 'ackParser'):
+            raise AttributeError(name)
+        
+        def command(*args):
+            return self.execute(lambda client: getattr(client, name)(*args))
+        
+        return command
+
+
+# Background subscriber keeping a snapshot of the MPD status (play state, volume, queue) 
+# up to date from 'idle' events, so that status queries need no round trip to the server.
+# Uses a dedicated connection, since a connection waiting for idle events cannot send commands.
+class MpdStateCache(threading.Thread):
+    def __init__(self, logger, host=u'localhost', port=6600, socketPath=None, 
+                 subsystems=(u'player', u'mixer', u'playlist', u'options', u'update', u'database')):
+        super(MpdStateCache, self).__init__()
+        self.setName("MpdStateCache")
+        self.daemon = True
+        self.logger = logger
+        
+        self.host = host
+        self.port = port
+        self.socketPath = socketPath
+        self.subsystems = subsystems
+        
+        self.client = MPDClient()
+        self.client.timeout = 10
+        self.client.idletimeout = None
+        
+        # Latest status snapshot (None while not subscribed, i.e. unknown)
+        self.status = None
+        self.condition = threading.Condition()
+        
+        self.stopRequested = threading.Event()
+        # Period (s) for checking whether a stop is requested while waiting for events
+        self.stopCheckPeriod = 1.0
+        # Period (s) before attempting to reconnect after a failure
+        self.retryPeriod = 5.0
+        
+    # Returns a copy of the current status snapshot, or None if it is not known
+    def getStatus(self):
+        with self.condition:
+            if self.status is None:
+                return None
+            return dict(self.status)
+        
+    # Update the snapshot right away after a command of ours (the idle event confirms it later)
+    def updateStatus(self, **values):
+        with self.condition:
+            if self.status is not None:
+                for key, value in values.items():
+                    self.status[key] = u'{}'.format(value)
+                
+    # Wait until the status changes (or the timeout expires). Returns right away after the timeout
+    # if the state cache is not running, so that callers end up polling
+    def waitForChange(self, timeout):
+        with self.condition:
+            self.condition.wait(timeout)
+        
+    def stop(self):
+        self.stopRequested.set()
+        
+    def refresh(self):
+        status = self.client.status()
+        with self.condition:
+            self.status = status
+            self.condition.notify_all()
+        
+    def run(self):
+        self.logger.debug("MpdStateCache starting")
+        while not self.stopRequested.is_set():
+            try:
+                if self.socketPath is not None:
+                    self.client.connect(self.socketPath)
+                else:
+                    self.client.connect(self.host, self.port)
+                self.refresh()
+                
+                while not self.stopRequested.is_set():
+                    self.client.send_idle(*self.subsystems)
+                    while not self.stopRequested.is_set():
+                        readable, _, _ = select.select([self.client], [], [], self.stopCheckPeriod)
+                        if readable:
+                            break
+                    if self.stopRequested.is_set():
+                        self.client.noidle()
+                        break
+                    changes = self.client.fetch_idle()
+                    self.logger.debug(u'MPD state changed: {}'.format(u', '.join(changes)))
+                    self.refresh()
+            except Exception as e:
+                self.logger.debug(u'MpdStateCache: Lost connection to MPD ({})'.format(e))
+            
+            # Status no longer tracked: Callers have to query the server
+            with self.condition:
+                self.status = None
+                self.condition.notify_all()
+            try:
+                self.client.disconnect()
+            except:
+                pass
+            
+            self.stopRequested.wait(self.retryPeriod)
+        self.logger.debug("MpdStateCache stopping")
+
+
 class MpdInterface(PlayerInterface):
-    def __init__(self, logger):
+    def __init__(self, logger, host=u'localhost', port=6600, socketPath=None, 
+                 copyWorkers=4, maxConnectionsPerServer=2, copyBandwidthLimit=None):
         # Logging mechanism
         self.logger = logger
         
@@ -18,54 +246,73 @@ class MpdInterface(PlayerInterface):
         #super(MpdInterface, self).__init__(self.logger)
         PlayerInterface.__init__(self, self.logger)
         
-        # Initialize MCP client
-        self.client = MPDClient()
-        self.client.timeout = 10
+        # Initialize MPD client (a single connection, kept open between commands)
+        self.client = MpdConnection(self.logger, host, port, socketPath)
+        # Status snapshot maintained from MPD idle events (started upon connecting)
+        self.stateCache = MpdStateCache(self.logger, host, port, socketPath)
+        
+        # SMB connections for copying music files, reused across playlists
+        self.smbPool = SmbConnectionPool(self.logger, maxConnectionsPerServer=maxConnectionsPerServer)
+        # Music files, shared with the playlist directories (the library is made of links to the store)
+        self.store = MusicStore(u'store', self.logger)
+        # Exported playlists
+        self.playlistStore = PlaylistStore(u'playlists/playlists.db', self.logger)
+        # Location of the track files (remote and in the library)
+        self.uriIndex = UriIndex(self.playlistStore, u'music', self.logger)
+        # Number of files downloaded concurrently
+        self.copyWorkers = copyWorkers
+        # Overall download rate (bytes/s) shared by all transfers (None: no limit)
+        self.bandwidthLimiter = None
+        if copyBandwidthLimit is not None:
+            self.bandwidthLimiter = BandwidthLimiter(copyBandwidthLimit)
         
         # Limitations
         self.minVolume = 20 # Make sure the music is audible...
         self.maxVolume = 60 # ...but not painful
-		
         
     def connect(self): 
-        self.logger.debug("Connecting")
         try:
-            try:
-                if self.connected:
-                    self.logger.debug("Already connected: Attempt disconnecting")
-                    self.disconnect()
-            except:
-                pass
-                
-            self.logger.debug("Attempt connecting")
-            self.client.connect("localhost", 6600)
-            self.logger.debug("Connected")
+            self.client.connect()
             self.connected = True
         except:
             self.logger.debug("Not connected")
             self.connected = False
             
+        if self.connected and not self.stateCache.is_alive() and not self.stateCache.stopRequested.is_set():
+            try:
+                self.stateCache.start()
+            except RuntimeError:
+                # Already started once
+                pass
+            
     def disconnect(self):
         self.logger.debug("Disconnecting")
-        try:
-            self.logger.debug("Closing")
-            self.client.close()
-            self.logger.debug("Disconnecting")
-            self.client.disconnect()
-        except:
-             pass
-         
-        self.logger.debug("Not connected")
+        self.client.disconnect()
         self.connected = False
+        
+    def close(self):
+        self.stateCache.stop()
+        self.disconnect()
+        
+    # Current MPD status, from the local snapshot if available (otherwise from the server)
+    def getStatus(self):
+        status = self.stateCache.getStatus()
+        if status is None:
+            status = self.client.status()
+        return status
 
     def prepareRoom(self, room):
-        try:
-            self.connect()
-        except:
-            self.logger.error("Problem establishing connection to the MCP system")
-            return False
-                
-        self.disconnect()
+        self.connect()
+        
+        if not self.connected or not self.client.isAlive():
+            # Stale connection: Try once more from scratch
+            try:
+                self.client.reconnect()
+                self.connected = True
+            except:
+                self.logger.error("Problem establishing connection to the MPD system")
+                self.connected = False
+                return False
         
         return True
 
@@ -77,7 +324,7 @@ class MpdInterface(PlayerInterface):
             # Starting the same playlist again: Just start playing from the beginning again
             # without appending the tracks to the queue once more
             self.logger.debug("Playlist {} already active: Restarting from first song".format(playlistName))
-            client.play(0)
+            self.client.play(0)
             return        
         
         self.logger.debug("Clearing playlist")
@@ -106,7 +353,6 @@ class MpdInterface(PlayerInterface):
             self.logger.error("Problem playing playlist '{}'".format(playlistName))
             return
         
-        self.disconnect()        
         
     def startPlaylistAlt(self, playlistName, room):
         self.logger.debug("Starting playlist {}".format(playlistName))
@@ -127,7 +373,6 @@ class MpdInterface(PlayerInterface):
                 self.logger.error("Problem playing playlist '{}'".format(playlistName))
                 return
         
-        self.disconnect()
 
     def playTrackNb(self, trackNb, room):
         self.logger.debug("Playing track {:d}".format(trackNb))
@@ -154,7 +399,6 @@ class MpdInterface(PlayerInterface):
             self.logger.error("Problem playing track number '{:d}' (track index: {:d}, queue size: {:d})".format(trackNb, trackIndex, self.queueSize))
             return    
         
-        self.disconnect()
         
     def togglePlayPause(self, room):        
         self.logger.debug("Toggling play/pause")
@@ -162,7 +406,7 @@ class MpdInterface(PlayerInterface):
         
         try:
             currentState = None
-            currentState = self.client.status()['state']
+            currentState = self.getStatus()['state']
             
             # Make sure we won't go deaf right now
             self.soundCheck(room)
@@ -170,14 +414,15 @@ class MpdInterface(PlayerInterface):
             if currentState == 'play':
                 self.logger.debug("Pausing playback")
                 self.client.pause()
+                self.stateCache.updateStatus(state=u'pause')
                 self.cancelOffsetStartPlaylist = True
             else:
                 self.logger.debug("Resuming playback")
                 self.client.play()
+                self.stateCache.updateStatus(state=u'play')
         except:
             self.logger.error("Problem toggling play/pause (current state: {})".format(currentState))
         
-        self.disconnect()
         
     def skipToNext(self, room):
         self.logger.debug("Skipping to next track")
@@ -192,7 +437,6 @@ class MpdInterface(PlayerInterface):
         except:
             self.logger.error("Problem skipping to next song")
         
-        self.disconnect()
                   
     def skipToPrevious(self, room):
         self.logger.debug("Skipping to previous track")
@@ -207,8 +451,8 @@ class MpdInterface(PlayerInterface):
         except:
             self.logger.error("Problem skipping to previous song")
 
-        self.disconnect()
           
+    # Returns False if the volume could not be adjusted
     def adjustVolume(self, volumeDelta, room):
         self.logger.debug("Adjusting volume")
         self.connect()
@@ -219,24 +463,27 @@ class MpdInterface(PlayerInterface):
             volumeDelta = int(round(volumeDelta))
             volumeDelta *= 2
             
-            oldVol = int(self.client.status()['volume'])
+            oldVol = int(self.getStatus()['volume'])
             newVol = oldVol + volumeDelta
             
             # Enforce volume limits
             if newVol < self.minVolume:
                 self.logger.debug("Upping volume to {:d} [would have been {:d}]".format(self.minVolume, newVol))
-                self.client.setvol(self.minVolume)
+                newVol = self.minVolume
             elif newVol > self.maxVolume:
                 self.logger.debug("Limiting volume to {:d} [would have been {:d}]".format(self.maxVolume, newVol))
-                self.client.setvol(self.maxVolume)
+                newVol = self.maxVolume
             else:
                 self.logger.debug("Setting volume to {:d} [used to be {:d}]".format(newVol, oldVol))
+            
+            if newVol != oldVol:
                 self.client.setvol(newVol)
-            newVol = int(self.client.status()['volume'])
+                self.stateCache.updateStatus(volume=newVol)
+            return True
         except:
-            self.logger.error("Problem adjusting volume (old volume: {:d}, new volume: {:d}, delta: {:d})".format(oldVol, newVol, volumeDelta))
+            self.logger.error("Problem adjusting volume (old volume: {}, new volume: {}, delta: {:d})".format(oldVol, newVol, volumeDelta))
+            return False
 
-        self.disconnect()
         
     def soundCheck(self, room):
         #self.connect()
@@ -246,16 +493,20 @@ class MpdInterface(PlayerInterface):
         vol = -1
         newVol = -1
         try:
-            vol = int(self.client.status()['volume'])
+            vol = int(self.getStatus()['volume'])
+            newVol = vol
             
             # Enforce volume limits
             if vol < self.minVolume:
-                self.logger.debug(u'Upping volume to {:d} [would have been {:d}]'.format(self.minVolume, newVol))
-                self.client.setvol(self.minVolume)
+                newVol = self.minVolume
+                self.logger.debug(u'Upping volume to {:d} [would have been {:d}]'.format(newVol, vol))
             elif vol > self.maxVolume:
-                self.logger.debug(u'Limiting volume to {:d} [would have been {:d}]'.format(self.maxVolume, newVol))
-                self.client.setvol(self.maxVolume)
-            newVol = int(self.client.status()['volume'])
+                newVol = self.maxVolume
+                self.logger.debug(u'Limiting volume to {:d} [would have been {:d}]'.format(newVol, vol))
+            
+            if newVol != vol:
+                self.client.setvol(newVol)
+                self.stateCache.updateStatus(volume=newVol)
         except:
             self.logger.error(u'Problem adjusting volume (old volume: {:d}, new volume: {:d})'.format(vol, newVol))
 
@@ -267,51 +518,94 @@ class MpdInterface(PlayerInterface):
         
         try:
             currentState = None
-            currentState = self.client.status()['state']
+            currentState = self.getStatus()['state']
             
             isCurrentlyPlaying = currentState == 'play'
         except:
             self.logger.error(u'Problem determining play status (current state: {})'.format(currentState))
             isCurrentlyPlaying = False
         
-        self.disconnect()
         
         return isCurrentlyPlaying
     
     def copyPlaylistFiles(self, playlistName, room, overwrite=False):
         self.logger.debug(u'Copying playlist files')
+        result = CopyResult()
         
         try:
-            self.logger.debug(u'Define Playlist object')
-            playlist = Playlist(playlistName)
-            
-            playlistFile = u'playlists/{}.json'.format(playlistName)
-            if os.path.exists(playlistFile):
-                self.logger.debug(u'Read JSON')
-                playlist.readFromFile(playlistFile)
-                
+            playlist = self.playlistStore.getPlaylist(playlistName)
+            if playlist is not None:
                 self.logger.debug(u'Playlist {}'.format(playlist.name))
                     
                 self.logger.debug(u'Copying files')
-                playlist.copyFiles(u'music', u'toma', u'', overwrite, False, self.logger)
+                result = playlist.copyFiles(u'music', u'toma', u'', overwrite, False, self.logger, self.smbPool, 
+                                            self.copyWorkers, self.bandwidthLimiter, self.store, 
+                                            uriIndex=self.uriIndex)
+                for target, error in result.failed:
+                    self.logger.error(u'Playlist {}: could not copy {}: {}'.format(playlistName, target, error))
             else:
-                self.logger.debug(u'Playlist file {} does not exist; skipping'.format(playlistFile))
+                self.logger.debug(u'Playlist {} has not been exported; skipping'.format(playlistName))
         except:
             self.logger.error(u'Error while copying files for playlist "{}"'.format(playlistName))   
+            
+        return result
 
-    def updateLibrary(self):
+    # Update the music library (only the given directories if specified, all of it otherwise).
+    # Returns the id of the last update job
+    def updateLibrary(self, directories=None):
         self.logger.debug(u'Updating music library')
         
         self.connect()
         
         try:      
-            self.logger.debug(u'Updating music library')
-            self.client.update()
+            if directories is None:
+                self.logger.debug(u'Updating music library')
+                return int(self.client.update())
+            
+            # Directories within an updated directory need no separate update
+            directories = sorted(set(directories))
+            directories = [d for d in directories 
+                           if not any(d.startswith(u'{}/'.format(other)) for other in directories)]
+            if not directories:
+                return None
+            
+            self.logger.debug(u'Updating music library for {:d} directories'.format(len(directories)))
+            results = self.client.executeCommandList([(u'update', (d,)) for d in directories])
+            jobIds = []
+            for directory, result in zip(directories, results):
+                if isinstance(result, MpdCommandError):
+                    self.logger.error(u'Problem updating directory {}: {}'.format(directory, result))
+                else:
+                    jobIds.append(int(result))
+            return max(jobIds) if jobIds else None
         except:
             self.logger.error(u'Problem updating music library')
             raise
         
-        self.disconnect()  
+    # Wait until the update job jobId is complete (as notified by the state cache, with polling 
+    # as fallback). Returns False if it is not done after timeout (s)
+    def waitForLibraryUpdate(self, jobId, timeout=600, pollPeriod=2.0):
+        deadline = time.time() + timeout
+        while True:
+            # Queried on the command connection, thus reflecting the update command sent before
+            updating = self.client.status().get(u'updating_db')
+            if updating is None or int(updating) > jobId:
+                self.logger.debug(u'Music library update {:d} complete'.format(jobId))
+                return True
+            
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.logger.error(u'Music library update {:d} not complete after {} s'.format(jobId, timeout))
+                return False
+            self.stateCache.waitForChange(min(remaining, pollPeriod))
+        
+    # Update the library directories which received files and wait until MPD is done
+    def updateCopiedFiles(self, copyResult):
+        directories = [os.path.dirname(target) for target in copyResult.copied + copyResult.linked]
+        jobId = self.updateLibrary(directories)
+        if jobId is not None:
+            self.waitForLibraryUpdate(jobId)
+        
         
     def definePlaylist(self, playlistName, room):
         self.logger.debug(u'Defining playlist {}'.format(playlistName))
@@ -319,88 +613,118 @@ class MpdInterface(PlayerInterface):
         self.connect()
         
         try:      
-            self.logger.debug(u'Define Playlist object')
-            playlist = Playlist(playlistName)
-            
-            playlistFile = u'playlists/{}.json'.format(playlistName)
-            if os.path.exists(playlistFile):
-                self.logger.debug(u'Read JSON')
-                playlist.readFromFile(u'playlists/{}.json'.format(playlistName))
-                
+            playlist = self.playlistStore.getPlaylist(playlistName)
+            if playlist is not None:
                 self.logger.debug(u'Playlist {}'.format(playlist.name))
                 
-                self.logger.debug(u'Clearing playlist')
-                self.client.clear()
-                self.logger.debug(u'Initializing playlist')
-                self.logger.debug(u'Deleting possibly existing playlist {}'.format(playlistName))
-                try:
-                    self.client.rm(playlistName)
-                except:
-                    pass
+                # Delete the possibly existing playlist and add the tracks to the stored playlist
+                # directly, all in a single batch: The play queue (possibly playing) is left untouched
+                tracks = playlist.tracks
+                commands = [(u'rm', (playlistName,))]
+                for track in tracks:
+                    (server, share, path, localPath) = self.uriIndex.resolve(track.uri)
+                    commands.append((u'playlistadd', (playlistName, localPath)))
                 
-                for track, info in sorted(playlist.tracks.items(), key=lambda t: int(t[0])):
-                    self.logger.debug(u'Adding track {:d}'.format(int(track)))
-    
-                    artist = info[u'artist']
-                    album = info[u'album']
-                    title = info[u'title']
-                    trackNb = int(track)
-                    file = info[u'uri']
-                    
-                    (server, share, path) = playlist.parseUri(file, self.logger)
-                    path = os.path.join(u'music', path)
-                    self.logger.debug(u'Adding track to playlist: artist "{}", album "{}", title "{}", track "{}", path "{}"'
-                                      .format(artist, album, title, track, path))
-                    self.client.findadd(u'file', path)
-                    
-    
-                self.client.save(playlistName)
+                self.logger.debug(u'Sending {:d} commands for playlist {}'.format(len(commands), playlistName))
+                results = self.client.executeCommandList(commands)
+                
+                # Collect errors reported for individual tracks (e.g. missing from the music library)
+                firstTrackIndex = 1
+                nbMissing = 0
+                for index, result in enumerate(results):
+                    if not isinstance(result, MpdCommandError):
+                        continue
+                    if index < firstTrackIndex:
+                        # Deleting a playlist which does not exist yet is expected to fail
+                        continue
+                    track = tracks[index - firstTrackIndex]
+                    nbMissing += 1
+                    self.logger.error(u'Problem adding track {:d} ("{}", uri "{}") to playlist {}: {}'
+                                      .format(track.trackNb, track.title, track.uri, playlistName, result))
+                if nbMissing > 0:
+                    self.logger.error(u'Playlist {}: only {:d} of {:d} tracks found in the music library'
+                                      .format(playlistName, len(tracks) - nbMissing, len(tracks)))
             else:
-                self.logger.debug(u'Playlist file {} does not exist; skipping'.format(playlistFile))
+                self.logger.debug(u'Playlist {} has not been exported; skipping'.format(playlistName))
         except:
             self.logger.error(u'Problem adding playlist "{}"'.format(playlistName))
             raise
         
-        self.disconnect()            
-             
     def importPlaylist(self, playlistName, room, overwrite=False):
         self.logger.debug(u'Importing playlist {}'.format(playlistName))
-        self.copyPlaylistFiles(playlistName, room, overwrite)
+        self.store.beginSession()
+        try:
+            result = self.copyPlaylistFiles(playlistName, room, overwrite)
+        finally:
+            self.store.endSession()
+            self.uriIndex.save()
+            self.smbPool.closeAll()
         
-        self.updateLibrary()
+        self.updateCopiedFiles(result)
      
         self.definePlaylist(playlistName, room)     
             
-    def importAllPlaylists(self, room, overwrite=False):
+    # Copy the files of all playlists, and define the playlists in MPD.
+    # progress(fraction) is called after each playlist; the import stops early once cancel() returns True
+    def importAllPlaylists(self, room, overwrite=False, progress=None, cancel=None):
         self.logger.debug(u'Importing all playlists')
         
         try:
             playlistBasename = u'zCharliebert_'
-            
-            # First copy files
+            playlistNames = []
             for bank in (u'A', u'B', u'C', u'D'):
                 for kind in (u'', u'_alt'):
                     for nb in range(1, 13):
-                        try:
-                            playlistName = u'{}{}{:02d}{}'.format(playlistBasename, bank, nb, kind)
-                            self.copyPlaylistFiles(playlistName, room, overwrite)
-                            
-                            self.updateLibrary()
-                        except:
-                            self.logger.error(u'Error while copying files for playlist {}'.format(playlistName))                    
+                        playlistNames.append(u'{}{}{:02d}{}'.format(playlistBasename, bank, nb, kind))
+            
+            result = CopyResult()
+            self.store.beginSession()
+            
+            # First copy files
+            canceled = False
+            try:
+                for index, playlistName in enumerate(playlistNames):
+                    if cancel is not None and cancel():
+                        self.logger.info(u'Import canceled')
+                        canceled = True
+                        break
+                    try:
+                        result.merge(self.copyPlaylistFiles(playlistName, room, overwrite))
+                    except:
+                        self.logger.error(u'Error while copying files for playlist {}'.format(playlistName))                    
+                    if progress is not None:
+                        progress(0.8 * (index + 1) / len(playlistNames))
+            finally:
+                self.store.endSession()
+                self.uriIndex.save()
+                self.smbPool.closeAll()
+            self.logger.info(u'Files for all playlists: {}'.format(result))
+            if canceled:
+                return
+            
+            # Files no playlist refers to any more
+            try:
+                self.store.prune(self.playlistStore.getTrackUris())
+            except Exception as e:
+                self.logger.error(u'Problem pruning the music store: {}'.format(e))
+            
+            # ...then have MPD scan the directories which received files...
+            self.updateCopiedFiles(result)
+            if progress is not None:
+                progress(0.85)
                     
-            # ...then update the playlist definitions
-            # (if the playlist is set right after the files have been copied, 
-            # it seems the music library is not yet properly updated, leading
-            # to missing tracks and/or empty playlists)
-            for bank in (u'A', u'B', u'C', u'D'):
-                for kind in (u'', u'_alt'):
-                    for nb in range(1, 13):             
-                        playlistName = u'{}{}{:02d}{}'.format(playlistBasename, bank, nb, kind)
-                        try:
-                            self.definePlaylist(playlistName, room)
-                        except:
-                            self.logger.error(u'Error while defining playlist {}'.format(playlistName))      
+            # ...then update the playlist definitions, once the library update is complete
+            # (otherwise tracks missing from the library lead to incomplete and/or empty playlists)
+            for index, playlistName in enumerate(playlistNames):
+                if cancel is not None and cancel():
+                    self.logger.info(u'Import canceled')
+                    return
+                try:
+                    self.definePlaylist(playlistName, room)
+                except:
+                    self.logger.error(u'Error while defining playlist {}'.format(playlistName))      
+                if progress is not None:
+                    progress(0.85 + 0.15 * (index + 1) / len(playlistNames))
 
         except:
             self.logger.error(u'Problem importing playlists')
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from fileTransfer import TransferManifest, lockFile
+
+
+# Content-addressed store of music files: Each file is kept once under objects/<sha1>,
+# whichever playlists it belongs to, and an index maps the remote URIs to the checksums.
+# The MPD library and the playlist directories are views made of links to the objects.
+# Several processes may use the store (player and maintenance job): The index is merged
+# with the one on disk when saving, under a file lock.
+class MusicStore:
+    def __init__(self, root=u'store', logger=None):
+        self.logger = logger
+        self.root = root
+        self.objectsDir = os.path.join(root, u'objects')
+        self.tmpDir = os.path.join(root, u'tmp')
+        self.indexFile = os.path.join(root, u'index.json')
+
+        # {uri: sha1}
+        self.index = {}
+        # Changes not saved yet {uri: sha1, or None if removed}
+        self.indexChanges = {}
+        # Objects more recent than this (s) are never pruned (their URI may not be saved yet by another process)
+        self.pruneGracePeriod = 3600
+        # URIs fetched during the current session (never fetched twice in a session)
+        self.sessionUris = set()
+
+        self.lock = threading.Lock()
+        # Locks preventing concurrent downloads of the same URI {uri: lock}
+        self.uriLocks = {}
+
+        for directory in (self.root, self.objectsDir, self.tmpDir):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+
+        self.loadIndex()
+        # Remote attributes of the files in the store
+        self.manifest = TransferManifest(os.path.join(root, u'manifest.json'))
+
+    def readIndex(self):
+        try:
+            with open(self.indexFile, 'r') as fp:
+                return json.load(fp)
+        except IOError:
+            return {}
+        except ValueError:
+            if self.logger is not None:
+                self.logger.error(u'Music store index {} is corrupted: starting over'.format(self.indexFile))
+            return {}
+
+    def loadIndex(self):
+        self.index = self.readIndex()
+
+    # Merge the changes into the index on disk (lock file held); returns the merged index
+    def mergeIndex(self, changes):
+        index = self.readIndex()
+        for uri, checksum in changes.items():
+            if checksum is None:
+                index.pop(uri, None)
+            else:
+                index[uri] = checksum
+        return index
+
+    def writeIndex(self, index):
+        tmpFile = u'{}.tmp'.format(self.indexFile)
+        with open(tmpFile, 'w') as fp:
+            json.dump(index, fp, indent=2, sort_keys=True)
+        os.rename(tmpFile, self.indexFile)
+
+    # Index in memory: The one saved, plus the changes made meanwhile
+    def setIndex(self, index):
+        with self.lock:
+            for uri, checksum in self.indexChanges.items():
+                if checksum is None:
+                    index.pop(uri, None)
+                else:
+                    index[uri] = checksum
+            self.index = index
+
+    def saveIndex(self):
+        with self.lock:
+            if not self.indexChanges:
+                return
+            changes = self.indexChanges
+            self.indexChanges = {}
+        with lockFile(u'{}.lock'.format(self.indexFile)):
+            index = self.mergeIndex(changes)
+            self.writeIndex(index)
+        self.setIndex(index)
+
+    # Remove the URIs no longer referenced (by any playlist) from the index, and delete the objects
+    # no URI refers to. Objects still linked from a view only free their space once the view is updated
+    def prune(self, referencedUris):
+        referencedUris = set(referencedUris)
+        with self.lock:
+            changes = self.indexChanges
+            self.indexChanges = {}
+        with lockFile(u'{}.lock'.format(self.indexFile)):
+            index = self.mergeIndex(changes)
+            removedUris = [uri for uri in index if uri not in referencedUris]
+            for uri in removedUris:
+                del index[uri]
+            self.writeIndex(index)
+        self.setIndex(index)
+        self.manifest.remove(removedUris)
+        self.manifest.save()
+
+        with self.lock:
+            checksums = set(self.index.values())
+        nbRemoved = 0
+        freedSize = 0
+        minTime = time.time() - self.pruneGracePeriod
+        for name in os.listdir(self.objectsDir):
+            if name in checksums:
+                continue
+            objectPath = self.getObjectPath(name)
+            try:
+                stat = os.stat(objectPath)
+                if stat.st_mtime > minTime:
+                    continue
+                os.remove(objectPath)
+            except OSError as e:
+                if self.logger is not None:
+                    self.logger.error(u'Cannot remove {} from the music store: {}'.format(objectPath, e))
+                continue
+            nbRemoved += 1
+            if stat.st_nlink == 1:
+                freedSize += stat.st_size
+
+        if self.logger is not None:
+            self.logger.info(u'Music store pruned: {:d} URIs and {:d} objects removed ({:d} bytes freed)'
+                             .format(len(removedUris), nbRemoved, freedSize))
+        return nbRemoved
+
+    # Start a sync session: Files are fetched again (if required) at most once per session
+    def beginSession(self):
+        with self.lock:
+            self.sessionUris = set()
+
+    def endSession(self):
+        self.saveIndex()
+        self.manifest.save()
+
+    def getObjectPath(self, checksum):
+        return os.path.join(self.objectsDir, checksum)
+
+    # Path of the object for uri, or None if not in the store
+    def lookup(self, uri):
+        with self.lock:
+            checksum = self.index.get(uri)
+        if checksum is None:
+            return None
+        objectPath = self.getObjectPath(checksum)
+        return objectPath if os.path.isfile(objectPath) else None
+
+    def getUriLock(self, uri):
+        with self.lock:
+            if uri not in self.uriLocks:
+                self.uriLocks[uri] = threading.Lock()
+            return self.uriLocks[uri]
+
+    # Object for uri, calling retrieve(tmpFile) to download it (returning its SHA-1 checksum)
+    # if it is not in the store yet, or if refresh is set and it was not fetched during this session.
+    # Returns (object path, whether the file was downloaded)
+    def fetch(self, uri, retrieve, refresh=False):
+        with self.getUriLock(uri):
+            objectPath = self.lookup(uri)
+            if objectPath is not None and (not refresh or uri in self.sessionUris):
+                return (objectPath, False)
+
+            # The name of the temporary file is stable, so that an interrupted download can be resumed
+            tmpFile = os.path.join(self.tmpDir, hashlib.sha1(uri.encode('utf8')).hexdigest())
+            checksum = retrieve(tmpFile)
+
+            objectPath = self.getObjectPath(checksum)
+            if os.path.isfile(objectPath):
+                # Same content as another URI
+                os.remove(tmpFile)
+            else:
+                os.rename(tmpFile, objectPath)
+
+            with self.lock:
+                self.index[uri] = checksum
+                self.indexChanges[uri] = checksum
+                self.sessionUris.add(uri)
+
+            return (objectPath, True)
+
+    # Make target refer to the object (hard link, or symbolic link if the view lives on another file system).
+    # Returns False if it already did
+    def link(self, objectPath, target):
+        if os.path.lexists(target):
+            if os.path.exists(target) and os.path.samefile(objectPath, target):
+                return False
+            os.remove(target)
+
+        try:
+            os.makedirs(os.path.dirname(target))
+        except OSError:
+            pass
+
+        try:
+            os.link(objectPath, target)
+        except OSError:
+            os.symlink(os.path.abspath(objectPath), target)
+        return True
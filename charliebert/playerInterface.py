@@ -6,65 +6,171 @@ import json
 import io
 import os
 import re
-from smb.SMBConnection import SMBConnection
+import hashlib
+from multiprocessing.pool import ThreadPool
+from smbConnectionPool import SmbConnectionPool
+from uriIndex import UriIndex
+from fileTransfer import CopyResult, TransferManifest, downloadFile, listRemoteAttributes
+
+# Track of a playlist (slots: no per-instance dict)
+class Track(object):
+    __slots__ = ('trackNb', 'artist', 'album', 'title', 'uri')
+    # Fields written to JSON files, in (sorted) file order
+    fields = ('album', 'artist', 'title', 'uri')
+    
+    def __init__(self, trackNb, artist, album, title, uri):
+        self.trackNb = int(trackNb)
+        self.artist = artist
+        self.album = album
+        self.title = title
+        self.uri = uri
+
+
+# Incremental reader for playlist JSON files: Tracks are decoded one at a time 
+# from a buffer refilled as needed, instead of loading the whole document at once
+class PlaylistJSONReader:
+    def __init__(self, fp, chunkSize=65536):
+        self.fp = fp
+        self.chunkSize = chunkSize
+        self.decoder = json.JSONDecoder()
+        self.buffer = u''
+        self.pos = 0
+        self.eof = False
+        
+    def fill(self):
+        data = self.fp.read(self.chunkSize)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+        
+    # Next character which is not white space (None at the end of the file)
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return None
+            
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(u'Expected "{}" at offset {:d}'.format(char, self.pos))
+        self.pos += 1
+        
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A value ending with the buffer might continue in the next chunk
+                if end < len(self.buffer) or self.eof or not self.fill():
+                    self.pos = end
+                    return obj
+            except ValueError:
+                if not self.fill():
+                    raise
+        
+    # Members (key, value) of the object starting at the current position; 
+    # values of the keys in streamed are returned as generators of their members
+    def members(self, streamed=()):
+        self.expect(u'{')
+        if self.peek() == u'}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(u':')
+            if key in streamed:
+                for member in self.members():
+                    yield (key, member)
+            else:
+                yield (key, self.value())
+            char = self.peek()
+            self.pos += 1
+            if char == u'}':
+                return
+            if char != u',':
+                raise ValueError(u'Expected "," or "}}" at offset {:d}'.format(self.pos - 1))
+        
 
 class Playlist:
     def __init__(self, name):
         self.name = name
-        self.tracks = dict()
+        # Tracks ordered by track number
+        self.tracks = []
+        
+    # JSON document in chunks (same output as json.dumps with sorted keys and an indentation of 4)
+    def iterJSON(self):
+        encode = json.JSONEncoder(ensure_ascii=False).encode
+        yield u'{{\n    "name": {}, \n    "tracks": {{'.format(encode(self.name))
+        for index, track in enumerate(self.tracks):
+            yield u'{}\n        "{:d}": {{'.format(u', ' if index > 0 else u'', track.trackNb)
+            yield u', '.join(u'\n            "{}": {}'.format(field, encode(getattr(track, field))) for field in Track.fields)
+            yield u'\n        }'
+        yield u'\n    }\n}' if self.tracks else u'}\n}'
         
     def toJSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4, ensure_ascii=False)
+        return u''.join(self.iterJSON())
+        
+    # Hash of the playlist content (name and tracks), for detecting changes
+    def contentHash(self):
+        checksum = hashlib.sha1()
+        for chunk in self.iterJSON():
+            checksum.update(chunk.encode('utf8'))
+        return checksum.hexdigest()
         
     def addTrack(self, trackNb, artist, album, title, uri):
-        self.tracks[trackNb] = dict()
-        t = self.tracks[trackNb]
-
-        t[u'artist'] = artist
-        t[u'album'] = album
-        t[u'title'] = title
-        t[u'uri'] = uri
+        track = Track(trackNb, artist, album, title, uri)
+        if not self.tracks or self.tracks[-1].trackNb < track.trackNb:
+            self.tracks.append(track)
+            return
         
-    def writeToFile(self, filename):
+        # Out of order: Insert at its place, replacing a track with the same number
+        for index, other in enumerate(self.tracks):
+            if other.trackNb == track.trackNb:
+                self.tracks[index] = track
+                return
+            if other.trackNb > track.trackNb:
+                self.tracks.insert(index, track)
+                return
         
+    def writeToFile(self, filename):
         with io.open(filename, 'w', encoding='utf8') as outfile:
-#             data = json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4, ensure_ascii=False)
-            data = self.toJSON()
-            outfile.write(unicode(data))
-             
-#         with open(filename, 'w') as outfile:
-#             json.dump(self, outfile, default=lambda o: o.__dict__, sort_keys=True, indent=4)
+            for chunk in self.iterJSON():
+                outfile.write(chunk)
 
     def readFromFile(self, filename):
-        
-#         logger.debug(u'readFromFile {}'.format(filename))
-        with open(filename) as json_data:
-#             self = json.load(json_data)
-#             logger.debug(u'Opened file {}'.format(filename))
-            data = json.load(json_data)
- 
-#             logger.debug(u'Setting name')
-            self.name = data[u'name']
-#             logger.debug(u'Setting tracks')
-            self.tracks = data[u'tracks']
-#             logger.debug(u'All set')
+        with io.open(filename, 'r', encoding='utf8') as infile:
+            self.tracks = []
+            for key, value in PlaylistJSONReader(infile).members(streamed=(u'tracks',)):
+                if key == u'name':
+                    self.name = value
+                elif key == u'tracks':
+                    (trackNb, t) = value
+                    self.addTrack(trackNb, t[u'artist'], t[u'album'], t[u'title'], t[u'uri'])
 
 
     def parseUri(self, uri, logger=None):
-        if logger is not None:
-            logger.debug(u'Parsing uri {}'.format(uri))
-        m = re.search(u'//([^/]+)/([^/]+)/(.+)\s*$', uri)
-                
-        if logger is not None:
-            logger.debug(u'group 1 = {}\ngroup 2 = {}\ngroup 3 = {}'.format(m.group(1), m.group(2), m.group(3)))
-
-        server = u'{}.local'.format(m.group(1))
-        share = u'{}'.format(m.group(2))
-        path = u'{}'.format(m.group(3))
-        
-        return (server, share, path)
+        return UriIndex.parse(uri)
 
-    def copyFiles(self, destDir, user, password, overwrite=False, basename=False, logger=None):
+    # Copy the files of all tracks to destDir (keeping the remote path, or only the file name with basename).
+    # Files are downloaded into a temporary file first, and interrupted downloads are resumed.
+    # SMB connections are taken from the given pool (shared across playlists), or from a pool 
+    # used for this playlist only. With several workers, files are downloaded concurrently 
+    # (the pool limits the concurrency per server), optionally throttled by a BandwidthLimiter.
+    # With a MusicStore, each file is downloaded into the store (once per sync session, even if 
+    # overwrite is set) and linked to from destDir.
+    # The remote size and modification time are listed once per directory: Missing or truncated 
+    # files are always copied, and with overwrite only the files which changed remotely since they 
+    # were copied (according to the manifest: the one of the store, or <destDir>/.manifest.json).
+    # URIs are resolved through the given UriIndex (or an index for this playlist only).
+    # Returns a CopyResult listing the copied, linked, skipped and failed files.
+    def copyFiles(self, destDir, user, password, overwrite=False, basename=False, logger=None, pool=None, 
+                  workers=1, bandwidthLimiter=None, store=None, manifest=None, uriIndex=None):
         if logger is not None:
             logger.debug(u'Playlist.copyFiles')
             
@@ -74,81 +180,135 @@ class Playlist:
             if logger is not None:
                 logger.debug(u'Error while making dir {}'.format(destDir))
 
-        if logger is not None:
-            logger.debug(u'Copying tracks')
-                    
-        try:
-            copiedFiles = []
-            for track in self.tracks:
-                file = self.tracks[track][u'uri']
-#                 m = re.search(u'//([^/]+)/([^/]+)/(.+)\s*$', file)
-#                 
-#                 if logger is not None:
-#                     logger.debug(u'group 1 = {}\ngroup 2 = {}\ngroup 3 = {}'.format(m.group(1), m.group(2), m.group(3)))
-#           
-#                 server = u'{}.local'.format(m.group(1))
-#                 share = u'{}'.format(m.group(2))
-#                 path = u'{}'.format(m.group(3))
-#                 target= u'{}'.format(m.group(3))
-                (server, share, path) = self.parseUri(file, logger)
+        ownPool = pool is None
+        if ownPool:
+            pool = SmbConnectionPool(logger)
+            
+        ownManifest = manifest is None and store is None
+        if manifest is None:
+            manifest = store.manifest if store is not None else TransferManifest(os.path.join(destDir, u'.manifest.json'))
+            
+        user = user.encode('utf8', 'ignore')
+        password = password.encode('utf8', 'ignore')
+        result = CopyResult()
+        if uriIndex is None:
+            uriIndex = UriIndex()
+        
+        files = []
+        for track in self.tracks:
+            try:
+                uri = track.uri
+                (server, share, path, localPath) = uriIndex.resolve(uri)
                 target = path
-                
-                if logger is not None:
-                     logger.debug(u'server = {}\nshare = {}\npath = {}'.format(server, share, path))
          
                 if basename:
                     target = os.path.basename(target)
                 
-                if logger is not None:
-                    logger.debug(u'server = {}\nshare = {}\npath = {}\ntarget = {}'.format(server, share, path, target))
-                
-                if logger is not None:
-                    logger.debug(u'Determining target file using additional dir \'{}\''.format(destDir))
-                
                 target = os.path.join(destDir, target)
                 
-                if os.path.isfile(target) and not overwrite:
-                    continue
-                
-                dir = os.path.dirname(target)
-         
+                files.append((uri, server.encode('utf8', 'ignore'), share.encode('utf8', 'ignore'), path, target))
+            except Exception as e:
+                result.addFailed(track.uri, e)
+        
+        # List the remote attributes once per directory
+        directoryAttributes = {}
+        for (server, share, directory) in set((f[1], f[2], os.path.dirname(f[3])) for f in files):
+            try:
+                with pool.connection(server, share, user, password) as conn:
+                    directoryAttributes[(server, share, directory)] = listRemoteAttributes(conn, share, directory)
+            except Exception as e:
                 if logger is not None:
-                    logger.debug(u'Target file: \'{}\''.format(target))
-                    logger.debug(u'Dirname: \'{}\''.format(dir))
+                    logger.debug(u'Could not list {} (server = {}, share = {}): {}'.format(directory, server, share, e))
+        
+        # Determine the files to copy
+        tasks = []
+        for (uri, server, share, path, target) in files:
+            localFile = store.lookup(uri) if store is not None else target
             
-                try:
-                    os.makedirs(dir)
-                except OSError:
-                    pass
-         
-                if logger is not None:
-                    logger.debug(u'Converting strings')
-                                    
-                user = user.encode('utf8', 'ignore')
-                password = password.encode('utf8', 'ignore')
-                server = server.encode('utf8', 'ignore')
-                share = share.encode('utf8', 'ignore')    
+            attributes = directoryAttributes.get((server, share, os.path.dirname(path)))
+            if attributes is None:
+                # No remote information: Rely on the presence of the file
+                remote = None
+                upToDate = localFile is not None and os.path.isfile(localFile) and not overwrite
+            else:
+                remote = attributes.get(os.path.basename(path))
+                if remote is None:
+                    result.addFailed(target, u'File not found on the server')
+                    continue
+                upToDate = (localFile is not None and os.path.isfile(localFile) 
+                            and os.path.getsize(localFile) == remote[0]
+                            and (not overwrite or manifest.matches(uri, remote)))
                 
-                conn = SMBConnection(user, password, server, server, use_ntlm_v2 = True)
-                assert conn.connect(server, 139)
+            if upToDate:
+                try:
+                    if store is not None and store.link(localFile, target):
+                        result.addLinked(target)
+                    else:
+                        result.addSkipped(target)
+                except Exception as e:
+                    result.addFailed(target, e)
+                continue
                 
-                if logger is not None:
-                    logger.debug(u'Connection established, retrieving file')
+            tasks.append((uri, server, share, path, target, remote))
+        
+        def copyFile(task):
+            (uri, server, share, path, target, remote) = task
             
-                with open(target, 'wb') as fp:
-                    conn.retrieveFile(share, path, fp)
-         
-                copiedFiles.append(target)
+            def retrieve(destFile):
+                with pool.connection(server, share, user, password) as conn:
+                    return downloadFile(conn, share, path, destFile, bandwidthLimiter, logger, 
+                                        remoteAttributes=remote)
                 
-                if logger is not None:
-                    logger.debug(u'File retrieved')
+            try:
+                if store is not None:
+                    (objectPath, fetched) = store.fetch(uri, retrieve, True)
+                    store.link(objectPath, target)
+                    if not fetched:
+                        result.addLinked(target)
+                        return
+                    checksum = os.path.basename(objectPath)
+                else:
+                    try:
+                        os.makedirs(os.path.dirname(target))
+                    except OSError:
+                        pass
+                    checksum = retrieve(target)
                     
-                conn.close()
+                if remote is not None:
+                    manifest.update(uri, remote)
          
-            return copiedFiles
-        except:
-            if logger is not None:
-                logger.error(u'user = {}\npassword = {}\nserver = {}\nshare = {}\ntarget = {}'.format(user, password, server, share, target))
+                result.addCopied(target, checksum)
+                if logger is not None:
+                    logger.debug(u'File retrieved: \'{}\''.format(target))
+            except Exception as e:
+                result.addFailed(target, e)
+                if logger is not None:
+                    logger.error(u'Problem copying {} (server = {}, share = {}): {}'.format(target, server, share, e))
+        
+        if logger is not None:
+            logger.debug(u'Copying {:d} tracks ({:d} workers)'.format(len(tasks), workers))
+                    
+        try:
+            if workers > 1 and len(tasks) > 1:
+                threadPool = ThreadPool(min(workers, len(tasks)))
+                try:
+                    threadPool.map(copyFile, tasks)
+                finally:
+                    threadPool.close()
+                    threadPool.join()
+            else:
+                for task in tasks:
+                    copyFile(task)
+        finally:
+            if ownPool:
+                pool.closeAll()
+            if ownManifest:
+                manifest.save()
+                
+        if logger is not None:
+            logger.debug(u'Playlist {}: {}'.format(self.name, result))
+            
+        return result
 
     
 class PlayerInterface():
@@ -180,6 +340,11 @@ class PlayerInterface():
         self.logger.debug("connect")
         self.connected = False
         
+    # Release the connection(s) to the music system server when quitting
+    def close(self):
+        self.logger.debug("close")
+        self.connected = False
+        
     def printSpeakerList(self):
         self.logger.debug("printSpeakerList")
         print("Speaker: None")
@@ -245,8 +410,10 @@ class PlayerInterface():
     def skipToPrevious(self, room):
         self.logger.debug("skipToPrevious")
           
+    # Returns False if the volume could not be adjusted
     def adjustVolume(self, volumeDelta, room):
         self.logger.debug("adjustVolume")
+        return True
         
     def soundCheck(self, room):
         self.logger.debug("soundCheck")
@@ -0,0 +1,207 @@
+import os
+import re
+import glob
+import io
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from playerInterface import Playlist
+
+
+# All exported playlists in a single SQLite database: one row per playlist (with the Sonos
+# update ID and the content hash of the last export) and one row per track, indexed by
+# (playlist, track number). Each thread uses its own connection to the database.
+class PlaylistStore:
+    def __init__(self, path=u'playlists/playlists.db', logger=None):
+        self.logger = logger
+        self.path = path
+        self.local = threading.local()
+        # Number of playlists saved (i.e. whose content changed) through this store
+        self.nbSaved = 0
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+
+        with self.transaction() as conn:
+            conn.execute(u'CREATE TABLE IF NOT EXISTS playlists ('
+                         u'name TEXT PRIMARY KEY, updateId TEXT, hash TEXT)')
+            conn.execute(u'CREATE TABLE IF NOT EXISTS tracks ('
+                         u'playlist TEXT NOT NULL, trackNb INTEGER NOT NULL, '
+                         u'artist TEXT, album TEXT, title TEXT, uri TEXT NOT NULL, '
+                         u'PRIMARY KEY (playlist, trackNb))')
+            # Other synchronization state (e.g. update ID of the whole list of Sonos playlists)
+            conn.execute(u'CREATE TABLE IF NOT EXISTS syncState (key TEXT PRIMARY KEY, value TEXT)')
+            # Resolved track URIs (see UriIndex)
+            conn.execute(u'CREATE TABLE IF NOT EXISTS uris ('
+                         u'uri TEXT PRIMARY KEY, server TEXT, share TEXT, path TEXT, localPath TEXT)')
+
+        # Playlists exported before the store existed
+        if self.connection().execute(u'SELECT COUNT(*) FROM playlists').fetchone()[0] == 0:
+            self.migrateFromJson(directory if directory else u'.')
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Transactions are handled explicitly (see transaction)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            self.local.conn = conn
+            self.local.depth = 0
+        return conn
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    # Group updates: Committed together at the end of the outermost with block,
+    # or rolled back if an exception is raised. A nested block is a savepoint: If it fails,
+    # only its own updates are rolled back (e.g. a single playlist among all those exported)
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        depth = self.local.depth
+        if depth == 0:
+            conn.execute(u'BEGIN')
+        else:
+            conn.execute(u'SAVEPOINT level{:d}'.format(depth))
+        self.local.depth += 1
+        try:
+            yield conn
+        except:
+            self.local.depth -= 1
+            if depth == 0:
+                conn.execute(u'ROLLBACK')
+            else:
+                conn.execute(u'ROLLBACK TO level{:d}'.format(depth))
+                conn.execute(u'RELEASE level{:d}'.format(depth))
+            raise
+        else:
+            self.local.depth -= 1
+            if depth == 0:
+                conn.execute(u'COMMIT')
+            else:
+                conn.execute(u'RELEASE level{:d}'.format(depth))
+
+    def hasPlaylist(self, name):
+        row = self.connection().execute(u'SELECT 1 FROM playlists WHERE name = ?', (name,)).fetchone()
+        return row is not None
+
+    # Playlist with its tracks, or None if it has not been exported
+    def getPlaylist(self, name):
+        conn = self.connection()
+        if conn.execute(u'SELECT 1 FROM playlists WHERE name = ?', (name,)).fetchone() is None:
+            return None
+
+        playlist = Playlist(name)
+        for row in conn.execute(u'SELECT trackNb, artist, album, title, uri FROM tracks '
+                                u'WHERE playlist = ? ORDER BY trackNb', (name,)):
+            playlist.addTrack(row['trackNb'], row['artist'], row['album'], row['title'], row['uri'])
+        return playlist
+
+    # Track details {artist, album, title, uri}, or None
+    def getTrack(self, name, trackNb):
+        row = self.connection().execute(u'SELECT artist, album, title, uri FROM tracks '
+                                        u'WHERE playlist = ? AND trackNb = ?', (name, trackNb)).fetchone()
+        if row is None:
+            return None
+        return dict((key, row[key]) for key in row.keys())
+
+    # Replace the tracks of the playlist
+    def savePlaylist(self, playlist, updateId=None, contentHash=None):
+        with self.transaction() as conn:
+            conn.execute(u'INSERT OR REPLACE INTO playlists (name, updateId, hash) VALUES (?, ?, ?)',
+                         (playlist.name, updateId, contentHash))
+            conn.execute(u'DELETE FROM tracks WHERE playlist = ?', (playlist.name,))
+            conn.executemany(u'INSERT INTO tracks (playlist, trackNb, artist, album, title, uri) '
+                             u'VALUES (?, ?, ?, ?, ?, ?)',
+                             ((playlist.name, t.trackNb, t.artist, t.album, t.title, t.uri)
+                              for t in playlist.tracks))
+        self.nbSaved += 1
+
+    # Sync information {updateId, hash} of the last export of the playlist ({} if never exported)
+    def getSyncInfo(self, name):
+        row = self.connection().execute(u'SELECT updateId, hash FROM playlists WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return {}
+        return {u'updateId': row['updateId'], u'hash': row['hash']}
+
+    def setSyncInfo(self, name, updateId, contentHash):
+        with self.transaction() as conn:
+            conn.execute(u'UPDATE playlists SET updateId = ?, hash = ? WHERE name = ?', (updateId, contentHash, name))
+
+    def getSyncState(self, key):
+        row = self.connection().execute(u'SELECT value FROM syncState WHERE key = ?', (key,)).fetchone()
+        return row['value'] if row is not None else None
+
+    def setSyncState(self, key, value):
+        with self.transaction() as conn:
+            conn.execute(u'INSERT OR REPLACE INTO syncState (key, value) VALUES (?, ?)', (key, value))
+
+    # URIs of the tracks of all playlists
+    def getTrackUris(self):
+        return set(row[0] for row in self.connection().execute(u'SELECT DISTINCT uri FROM tracks'))
+
+    # {uri: (server, share, path, localPath)}
+    def getUriEntries(self):
+        return dict((row['uri'], (row['server'], row['share'], row['path'], row['localPath']))
+                    for row in self.connection().execute(u'SELECT uri, server, share, path, localPath FROM uris'))
+
+    def saveUriEntries(self, entries):
+        with self.transaction() as conn:
+            conn.executemany(u'INSERT OR REPLACE INTO uris (uri, server, share, path, localPath) VALUES (?, ?, ?, ?, ?)',
+                             ((uri,) + tuple(entry) for uri, entry in entries.items()))
+
+    # Copy of the database (the lock held prevents concurrent writes)
+    def backup(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        conn = self.connection()
+        conn.execute(u'BEGIN IMMEDIATE')
+        try:
+            backupConn = sqlite3.connect(path)
+            try:
+                with backupConn:
+                    backupConn.executescript(u'\n'.join(conn.iterdump()))
+            finally:
+                backupConn.close()
+        finally:
+            conn.rollback()
+
+    # Import the playlists exported as JSON files (and their .sync files) by earlier versions
+    def migrateFromJson(self, directory=u'playlists'):
+        nameParser = re.compile(u'^(zCharliebert_[A-D][0-9]{2}(_alt)?)\.json$')
+        with self.transaction():
+            # Update ID of the list of Sonos playlists at the last complete export
+            try:
+                with io.open(os.path.join(directory, u'zCharliebert_.sync'), 'r', encoding='utf8') as syncFile:
+                    self.setSyncState(u'zCharliebert_', json.load(syncFile).get(u'updateId'))
+            except (IOError, ValueError):
+                pass
+            
+            for playlistFile in sorted(glob.glob(os.path.join(directory, u'*.json'))):
+                m = nameParser.match(os.path.basename(playlistFile))
+                if m is None or self.hasPlaylist(m.group(1)):
+                    continue
+
+                try:
+                    playlist = Playlist(m.group(1))
+                    playlist.readFromFile(playlistFile)
+                    syncInfo = {}
+                    try:
+                        with io.open(os.path.join(directory, u'{}.sync'.format(playlist.name)), 'r', encoding='utf8') as syncFile:
+                            syncInfo = json.load(syncFile)
+                    except (IOError, ValueError):
+                        pass
+                    self.savePlaylist(playlist, syncInfo.get(u'updateId'), syncInfo.get(u'hash'))
+                    if self.logger is not None:
+                        self.logger.debug(u'Migrated playlist {} to the playlist store'.format(playlist.name))
+                except:
+                    if self.logger is not None:
+                        self.logger.error(u'Problem migrating playlist file {}'.format(playlistFile))
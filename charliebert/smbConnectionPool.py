@@ -0,0 +1,131 @@
+import threading
+import time
+from contextlib import contextmanager
+from smb.SMBConnection import SMBConnection
+
+
+# Pool of authenticated SMB connections, keyed by (server, share, user), so that copying
+# many files (across tracks and playlists during a sync) does not pay the NetBIOS session
+# setup and the NTLMv2 authentication for every single file
+class SmbConnectionPool:
+    def __init__(self, logger=None, maxIdleTime=60, healthCheckPeriod=10, port=139, maxConnectionsPerServer=None):
+        self.logger = logger
+
+        # Connections unused for longer than maxIdleTime (s) are closed
+        self.maxIdleTime = maxIdleTime
+        # Connections unused for longer than healthCheckPeriod (s) are checked before being reused
+        self.healthCheckPeriod = healthCheckPeriod
+        self.port = port
+        # Maximum number of connections in use at the same time for a server (None: no limit)
+        self.maxConnectionsPerServer = maxConnectionsPerServer
+        self.serverSemaphores = {}
+
+        # Idle connections {key: [(connection, time of last use), ...]}
+        self.idleConnections = {}
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.nbCreated = 0
+        self.nbReused = 0
+
+    def getKey(self, server, share, user):
+        return (server, share, user)
+
+    def acquire(self, server, share, user, password):
+        key = self.getKey(server, share, user)
+        self.evictIdle()
+
+        while True:
+            with self.lock:
+                connections = self.idleConnections.get(key)
+                if not connections:
+                    break
+                conn, lastUsed = connections.pop()
+
+            if time.time() - lastUsed > self.healthCheckPeriod and not self.isHealthy(conn):
+                self.discard(conn)
+                continue
+
+            with self.lock:
+                self.nbReused += 1
+            return conn
+
+        return self.createConnection(server, user, password)
+
+    def release(self, server, share, user, conn):
+        key = self.getKey(server, share, user)
+        with self.lock:
+            self.idleConnections.setdefault(key, []).append((conn, time.time()))
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except:
+            pass
+
+    def getServerSemaphore(self, server):
+        with self.lock:
+            if server not in self.serverSemaphores:
+                self.serverSemaphores[server] = threading.BoundedSemaphore(self.maxConnectionsPerServer)
+            return self.serverSemaphores[server]
+
+    # Connection for the duration of a with block: Returned to the pool afterwards,
+    # or closed if an error occurred while using it.
+    # Waits if the maximum number of connections to the server are already in use.
+    @contextmanager
+    def connection(self, server, share, user, password):
+        semaphore = None
+        if self.maxConnectionsPerServer is not None:
+            semaphore = self.getServerSemaphore(server)
+            semaphore.acquire()
+
+        try:
+            conn = self.acquire(server, share, user, password)
+            try:
+                yield conn
+            except:
+                self.discard(conn)
+                raise
+            self.release(server, share, user, conn)
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+    def createConnection(self, server, user, password):
+        if self.logger is not None:
+            self.logger.debug(u'Opening SMB connection to {}'.format(server))
+        conn = SMBConnection(user, password, server, server, use_ntlm_v2 = True)
+        if not conn.connect(server, self.port):
+            raise IOError(u'Could not connect to {}'.format(server))
+        with self.lock:
+            self.nbCreated += 1
+        return conn
+
+    def isHealthy(self, conn):
+        try:
+            conn.echo(b'charliebert')
+            return True
+        except:
+            return False
+
+    def evictIdle(self):
+        expired = []
+        now = time.time()
+        with self.lock:
+            for key, connections in self.idleConnections.items():
+                expired.extend(conn for conn, lastUsed in connections if now - lastUsed > self.maxIdleTime)
+                self.idleConnections[key] = [(conn, lastUsed) for conn, lastUsed in connections if now - lastUsed <= self.maxIdleTime]
+
+        for conn in expired:
+            self.discard(conn)
+
+    def closeAll(self):
+        with self.lock:
+            connections = [conn for entries in self.idleConnections.values() for conn, lastUsed in entries]
+            self.idleConnections = {}
+
+        for conn in connections:
+            self.discard(conn)
+
+        if self.logger is not None:
+            self.logger.debug(u'SMB connections closed ({:d} opened, {:d} reuses)'.format(self.nbCreated, self.nbReused))
@@ -5,8 +5,164 @@ from logging.handlers import RotatingFileHandler
 from time import sleep
 import time
 import os
+import json
+import io
+import threading
+from multiprocessing.pool import ThreadPool
+try:
+    import Queue as Q # For python 2
+except:
+    import queue as Q # For python 3
 from playerInterface import Playlist
-import urllib
+from playlistStore import PlaylistStore
+from uriIndex import UriIndex
+try:
+    from soco.data_structures_entry import from_didl_string
+except ImportError:
+    from soco.data_structures import from_didl_string
+
+
+# Local copy of the transport state and volumes of the active speakers, kept up to date from 
+# UPnP events: AVTransport for the group coordinator, RenderingControl for each group member.
+# Values older than maxAge seconds are considered stale (the caller then asks the speaker); values of
+# speakers without an active subscription (failed, or lapsed renewal) are only kept for unwatchedMaxAge seconds,
+# since no event will update them.
+# The function subscribing to a service can be replaced, e.g. by a stand-in for the soco event 
+# listener: it receives a soco service and has to return an object with 'sid' and 'unsubscribe()',
+# events ('sid' and 'variables') being put into the 'events' queue of the cache.
+class SonosStateCache(threading.Thread):
+    def __init__(self, logger, subscribe=None, maxAge=600, unwatchedMaxAge=3):
+        super(SonosStateCache, self).__init__()
+        self.setName("SonosStateCache")
+        self.daemon = True
+        self.logger = logger
+        
+        self.subscribe = subscribe if subscribe is not None else self.subscribeService
+        self.usesEventListener = subscribe is None
+        self.maxAge = maxAge
+        self.unwatchedMaxAge = unwatchedMaxAge
+        
+        # Events of all subscriptions
+        self.events = Q.Queue()
+        # Active subscriptions {sid: (kind, speaker key, subscription)}
+        self.subscriptions = {}
+        # Cached values {kind: {speaker key: (value, time of the update)}}
+        self.values = {u'transport': {}, u'volume': {}}
+        self.lock = threading.Lock()
+        
+        self.started = False
+        
+    def subscribeService(self, service):
+        return service.subscribe(auto_renew=True, event_queue=self.events)
+    
+    # Speakers are identified by their address (available without network traffic)
+    def getKey(self, speaker):
+        return speaker.ip_address
+    
+    # Subscribe to the events of the given group (replacing the previous subscriptions)
+    def watch(self, coordinator, members):
+        self.unsubscribeAll()
+        
+        if not self.started:
+            self.started = True
+            self.start()
+        
+        try:
+            self.register(u'transport', coordinator, self.subscribe(coordinator.avTransport))
+            for member in members:
+                self.register(u'volume', member, self.subscribe(member.renderingControl))
+        except Exception as e:
+            self.logger.error(u'Problem subscribing to Sonos events ({}): Querying the speakers instead'.format(e))
+            self.unsubscribeAll()
+            
+    def register(self, kind, speaker, subscription):
+        with self.lock:
+            self.subscriptions[subscription.sid] = (kind, self.getKey(speaker), subscription)
+    
+    def unsubscribeAll(self):
+        with self.lock:
+            subscriptions = self.subscriptions.values()
+            self.subscriptions = {}
+            self.values = {u'transport': {}, u'volume': {}}
+        
+        for kind, key, subscription in subscriptions:
+            try:
+                subscription.unsubscribe()
+            except:
+                pass
+    
+    def handleEvent(self, event):
+        with self.lock:
+            entry = self.subscriptions.get(event.sid)
+            if entry is None:
+                return
+            kind, key, subscription = entry
+            variables = event.variables
+            
+            if kind == u'transport' and u'transport_state' in variables:
+                self.values[kind][key] = (variables[u'transport_state'], time.time())
+            elif kind == u'volume' and u'volume' in variables:
+                volume = variables[u'volume']
+                if isinstance(volume, dict):
+                    volume = volume.get(u'Master')
+                if volume is not None:
+                    self.values[kind][key] = (int(volume), time.time())
+    
+    # Whether events of the given kind are still received for the speaker (lock held)
+    def isWatched(self, kind, key):
+        for (subscriptionKind, subscriptionKey, subscription) in self.subscriptions.values():
+            if subscriptionKind == kind and subscriptionKey == key:
+                # soco subscriptions not renewed in time are marked as no longer subscribed
+                return getattr(subscription, 'is_subscribed', True)
+        return False
+                
+    def getValue(self, kind, speaker):
+        key = self.getKey(speaker)
+        with self.lock:
+            entry = self.values[kind].get(key)
+            maxAge = self.maxAge if self.isWatched(kind, key) else self.unwatchedMaxAge
+        if entry is None or time.time() - entry[1] > maxAge:
+            return None
+        return entry[0]
+    
+    def getTransportState(self, speaker):
+        return self.getValue(u'transport', speaker)
+    
+    def getVolume(self, speaker):
+        return self.getValue(u'volume', speaker)
+    
+    # Store values obtained otherwise (by querying the speaker or after sending a command)
+    def setTransportState(self, speaker, state):
+        with self.lock:
+            self.values[u'transport'][self.getKey(speaker)] = (state, time.time())
+    
+    def setVolume(self, speaker, volume):
+        with self.lock:
+            self.values[u'volume'][self.getKey(speaker)] = (volume, time.time())
+        
+    def stop(self):
+        self.unsubscribeAll()
+        self.events.put(None)
+        
+        if self.usesEventListener:
+            try:
+                from soco.events import event_listener
+                if event_listener.is_running:
+                    event_listener.stop()
+            except:
+                pass
+        
+    def run(self):
+        self.logger.debug("SonosStateCache starting")
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            try:
+                self.handleEvent(event)
+            except Exception as e:
+                self.logger.error(u'Problem processing Sonos event: {}'.format(e))
+        self.logger.debug("SonosStateCache stopping")
 
     
 class SonosInterface(PlayerInterface):
@@ -19,11 +175,39 @@ class SonosInterface(PlayerInterface):
         self.speakers = {}
         self.names = []
         
-        # Currently selected Sonos speaker
+        # Currently selected Sonos speaker (coordinator of the group of speakerRoom)
         self.speaker = None
+        self.speakerRoom = None
         
         self.connected = False
         
+        # Network the speakers are looked for in (the discovery cache is kept per network)
+        self.network = None
+        # File where the addresses of the speakers found by discovery are kept: {network: {zone name: ip}}
+        self.speakerCacheFile = u'sonos_speakers.json'
+        # True if the current speakers come from the cache (i.e. have not been discovered right now)
+        self.speakersFromCache = False
+        # Rooms whose cached address has been checked since connecting
+        self.validatedRooms = set()
+        
+        # Members of the group of the selected speaker, and time they were determined
+        self.speakerMembers = []
+        self.speakerMembersTime = 0
+        # Period (s) after which the group members are determined anew
+        self.groupMaxAge = 60
+        # Number of playlist items requested per ContentDirectory browse call
+        self.browsePageSize = 500
+        # Exported playlists
+        self.playlistStore = PlaylistStore(u'playlists/playlists.db', self.logger)
+        # Location of the track files, resolved when exporting the playlists
+        self.uriIndex = UriIndex(self.playlistStore, u'music', self.logger)
+        
+        # Threads for adjusting the volume of several members at once (created when first needed)
+        self.memberPool = None
+        self.memberPoolSize = 4
+        # Transport state and volumes of the selected group, updated from UPnP events
+        self.stateCache = SonosStateCache(self.logger)
+        
         # Index of the first track of the current playlist in the queue 
         self.indexBegPlaylist = 0
         # Number of items in the current playlist
@@ -40,12 +224,24 @@ class SonosInterface(PlayerInterface):
         self.timeLastStartPlaylist = time.time() - self.minTimePlaylist # Make sure we can start a playlist right away
         self.cancelOffsetStartPlaylist = False # True if the playlist has been stopped before the end of the offset time
         
-    def connect(self): 
+    def connect(self, rediscover=False): 
+        # Reconnect directly to the speakers known for the current network, if any;
+        # only scan the network when there are none (or when explicitly asked to)
+        if not rediscover and self.connectFromCache():
+            return
+        
+        self.discoverSpeakers()
+        
+    def discoverSpeakers(self):
         # Prepare info about Sonos speakers
+        self.logger.debug(u'Discovering Sonos speakers (network {})'.format(self.network))
         self.speakers = {}
         self.names = []
+        self.speaker = None
+        self.speakerRoom = None
+        self.speakersFromCache = False
         
-        list_sonos = list(soco.discover())
+        list_sonos = list(soco.discover() or [])
     
         if len(list_sonos) == 0:
             self.connected = False
@@ -56,8 +252,83 @@ class SonosInterface(PlayerInterface):
             self.names.append(name)
             self.speakers[name] = speaker
             
+        # All addresses are fresh
+        self.validatedRooms = set(self.names)
         self.connected = True
         
+        self.saveSpeakerCache()
+        
+    def connectFromCache(self):
+        addresses = self.loadSpeakerCache().get(self.getNetworkKey())
+        if not addresses:
+            return False
+        
+        self.logger.debug(u'Using cached addresses for Sonos speakers (network {})'.format(self.network))
+        self.speakers = {}
+        self.names = []
+        self.speaker = None
+        self.speakerRoom = None
+        for name, ip in addresses.items():
+            self.names.append(name)
+            # No network traffic until the speaker is actually used
+            self.speakers[name] = soco.SoCo(ip)
+        
+        self.speakersFromCache = True
+        self.validatedRooms = set()
+        self.connected = True
+        return True
+    
+    def getNetworkKey(self):
+        if self.network is None:
+            return u'default'
+        return self.network
+    
+    def loadSpeakerCache(self):
+        try:
+            with io.open(self.speakerCacheFile, 'r', encoding='utf8') as cacheFile:
+                return json.load(cacheFile)
+        except:
+            return {}
+    
+    def saveSpeakerCache(self):
+        try:
+            cache = self.loadSpeakerCache()
+            cache[self.getNetworkKey()] = dict((name, speaker.ip_address) for name, speaker in self.speakers.items())
+            with io.open(self.speakerCacheFile, 'w', encoding='utf8') as cacheFile:
+                cacheFile.write(u'{}'.format(json.dumps(cache, ensure_ascii=False)))
+        except:
+            self.logger.error(u'Problem saving the Sonos speaker cache to {}'.format(self.speakerCacheFile))
+            
+    # Select the network the speakers are on (e.g. after switching the wifi network)
+    def setNetwork(self, network):
+        if network == self.network and self.connected:
+            return
+        
+        self.logger.debug(u'Sonos network: {}'.format(network))
+        self.network = network
+        self.connected = False
+        self.speakers = {}
+        self.names = []
+        self.speaker = None
+        self.speakerRoom = None
+        
+        # Reconnect right away to the speakers known for this network (no network traffic)
+        self.connectFromCache()
+        
+    # Drop the speaker selected for a room (e.g. after a failed command), so that it is checked again
+    def forgetSpeaker(self, room):
+        self.speaker = None
+        self.speakerRoom = None
+        self.speakerMembers = []
+        self.validatedRooms.discard(room)
+        
+    def close(self):
+        self.stateCache.stop()
+        if self.memberPool is not None:
+            self.memberPool.terminate()
+            self.memberPool = None
+        self.connected = False
+        
     def printSpeakerList(self):
         try:
             self.connect()
@@ -70,7 +341,11 @@ class SonosInterface(PlayerInterface):
     
     def prepareRoom(self, room):
         try:
-            self.connect()
+            if not self.connected:
+                self.connect()
+            if room not in self.names and self.speakersFromCache:
+                # Room unknown to the cache: Look for new speakers
+                self.connect(True)
         except:
             self.logger.error("Problem establishing connection to the Sonos system")
             return False
@@ -82,20 +357,70 @@ class SonosInterface(PlayerInterface):
         return True
                         
     def getSpeaker(self, room):
-        try:
-            # Try to access the stored object
-            if self.speaker.get_speaker_info()['zone_name'] == room:
-                # All good, the currently active speaker's name corresponds to our parameter
-                return self.speaker 
-        except:
-            if self.prepareRoom(room) is False:
-                self.logger.error("Cannot prepare room {}".format(room))
-                return None
-            
-            # There was a problem: Redefine the speaker
-            sp = self.speakers[room]
+        # Reuse the speaker selected for the room during the last command
+        if self.speaker is not None and self.speakerRoom == room:
+            if time.time() - self.speakerMembersTime > self.groupMaxAge:
+                # Check from time to time whether the group has changed
+                self.selectGroup(self.speaker)
+            return self.speaker
+        
+        if self.prepareRoom(room) is False:
+            self.logger.error("Cannot prepare room {}".format(room))
+            return None
+        
+        sp = self.speakers[room]
+        
+        if room not in self.validatedRooms:
+            try:
+                # Make sure the cached address still belongs to the room
+                if sp.get_speaker_info(True)['zone_name'] != room:
+                    raise ValueError(room)
+            except:
+                self.logger.debug("Cached address for room {} is outdated: Discovering speakers".format(room))
+                self.connect(True)
+                if room not in self.names:
+                    self.logger.error("Room '{}' not available in the Sonos system".format(room))
+                    return None
+                sp = self.speakers[room]
+            self.validatedRooms.add(room)
+        
+        self.selectGroup(sp)
+        self.speakerRoom = room
+        
+        return self.speaker
+    
+    # Select the group of the given speaker and subscribe to its events
+    def selectGroup(self, sp):
+        group = sp.group
+        members = list(group.members)
+        
+        if self.speaker is None or group.coordinator.ip_address != self.speaker.ip_address \
+        or set(m.ip_address for m in members) != set(m.ip_address for m in self.speakerMembers):
+            self.stateCache.watch(group.coordinator, members)
             
-            return sp.group.coordinator
+        self.speaker = group.coordinator
+        self.speakerMembers = members
+        self.speakerMembersTime = time.time()
+    
+    # Current transport state of the coordinator (from the event cache if possible)
+    def getTransportState(self, sp):
+        currentState = self.stateCache.getTransportState(sp)
+        if currentState is None:
+            currentState = sp.get_current_transport_info()[u'current_transport_state']
+            self.stateCache.setTransportState(sp, currentState)
+        return currentState
+    
+    # Current volume of a speaker (from the event cache if possible)
+    def getVolume(self, sp):
+        vol = self.stateCache.getVolume(sp)
+        if vol is None:
+            vol = sp.volume
+            self.stateCache.setVolume(sp, vol)
+        return vol
+    
+    def setVolume(self, sp, vol):
+        sp.volume = vol
+        self.stateCache.setVolume(sp, vol)
 
     def startPlaylistBare(self, playlistName, room):
         # Bare function to start a playlist; throws an exception if unsuccessful
@@ -131,6 +456,7 @@ class SonosInterface(PlayerInterface):
             self.startPlaylistBare(playlistName, room)
         except:
             self.logger.error("Problem playing playlist '{}'".format(playlistName))
+            self.forgetSpeaker(room)
         
     def startPlaylistAlt(self, playlistName, room):
         # Discard commands that are issued too briefly after the last
@@ -148,6 +474,7 @@ class SonosInterface(PlayerInterface):
                 self.startPlaylistBare(playlistName, room)
             except:  
                 self.logger.error("Problem playing playlist '{}'".format(playlistName))
+                self.forgetSpeaker(room)
                                 
     def playTrackNb(self, trackNb, room):
         if trackNb < 1:
@@ -167,24 +494,28 @@ class SonosInterface(PlayerInterface):
             sp.play_from_queue(trackIndex)
         except:
             self.logger.error("Problem playing track number '{:d}' (track index: {:d}, queue size: {:d})".format(trackNb, trackIndex, self.queueSize))
+            self.forgetSpeaker(room)
             return    
 
     def togglePlayPause(self, room):
         try:
             currentState = None
             sp = self.getSpeaker(room)
-            currentState = sp.get_current_transport_info()[u'current_transport_state']
+            currentState = self.getTransportState(sp)
             
             # Make sure we won't go deaf right now
             self.soundCheck(room)
             
             if currentState == 'PLAYING':
                 sp.pause()
+                self.stateCache.setTransportState(sp, u'PAUSED_PLAYBACK')
                 self.cancelOffsetStartPlaylist = True
             else:
                 sp.play()
+                self.stateCache.setTransportState(sp, u'PLAYING')
         except:
             self.logger.error("Problem toggling play/pause (current state: {})".format(currentState))
+            self.forgetSpeaker(room)
 
     def skipToNext(self, room):
         try:
@@ -197,6 +528,7 @@ class SonosInterface(PlayerInterface):
             self.cancelOffsetStartPlaylist = True
         except:
             self.logger.error("Problem skipping to next song")
+            self.forgetSpeaker(room)
           
     def skipToPrevious(self, room):
         try:
@@ -209,61 +541,134 @@ class SonosInterface(PlayerInterface):
             self.cancelOffsetStartPlaylist = True
         except:
             self.logger.error("Problem skipping to previous song")
+            self.forgetSpeaker(room)
           
+    # Returns False if the volume could not be adjusted (for any member)
     def adjustVolume(self, volumeDelta, room):
         try:
             volumeDelta = int(round(volumeDelta))
             targetSp = self.getSpeaker(room)
+            members = list(self.speakerMembers)
+            volumes = [self.stateCache.getVolume(sp) for sp in members]
             
-            for sp in targetSp.group.members:
-                oldVol = None
-                newVol = None
-                try:
-                    oldVol = sp.volume
-                    newVol = oldVol + volumeDelta
-                    
-                    # Enforce volume limits
-                    if newVol < self.minVolume:
-                        self.logger.debug("Upping volume to {:d} [would have been {:d}]".format(self.minVolume, newVol))
-                        sp.volume = self.minVolume
-                    elif newVol > self.maxVolume:
-                        self.logger.debug("Limiting volume to {:d} [would have been {:d}]".format(self.maxVolume, newVol))
-                        sp.volume = self.maxVolume
-                    else:
-                        sp.volume += volumeDelta
-                    newVol = sp.volume
-                except:
-                    self.logger.error("Problem adjusting volume for room {} (old volume: {:d}, new volume: {:d}, delta: {:d})".format(sp.player_name, oldVol, newVol, volumeDelta))
+            if len(members) > 0 and None not in volumes and self.isWithinLimits(volumes, volumeDelta):
+                # No member would cross a volume limit: Adjust the volume with a single relative call
+                if len(members) == 1:
+                    newVol = self.setRelativeVolume(members[0], volumeDelta)
+                    self.logger.debug("Volume of {} set to {:d} [used to be {:d}]".format(members[0].ip_address, newVol, volumes[0]))
+                else:
+                    newVol = self.setRelativeGroupVolume(targetSp, members, volumes, volumeDelta)
+                    self.logger.debug("Group volume set to {:d} (delta: {:d})".format(newVol, volumeDelta))
+                return True
+            
+            # Otherwise adjust each member separately, enforcing the limits
+            return all(self.forEachMember(members, lambda sp: self.adjustMemberVolume(sp, volumeDelta)))
+        except:
+            self.logger.error("Problem adjusting volume (delta: {:d})".format(volumeDelta))
+            return False
+            
+    # True if all given volumes stay within the limits after a relative change.
+    # Group volume changes are distributed proportionally to the member volumes,
+    # so louder members move by more than the delta itself.
+    def isWithinLimits(self, volumes, volumeDelta):
+        groupVol = float(sum(volumes)) / len(volumes)
+        for vol in volumes:
+            factor = max(1.0, vol / groupVol) if groupVol > 0 else 1.0
+            newVol = vol + volumeDelta * factor
+            if newVol < self.minVolume or newVol > self.maxVolume:
+                return False
+        return True
+    
+    def setRelativeVolume(self, sp, volumeDelta):
+        result = sp.renderingControl.SetRelativeVolume([
+            ('InstanceID', 0), 
+            ('Channel', 'Master'), 
+            ('Adjustment', volumeDelta)])
+        newVol = int(result['NewVolume'])
+        self.stateCache.setVolume(sp, newVol)
+        return newVol
+    
+    def setRelativeGroupVolume(self, coordinator, members, volumes, volumeDelta):
+        # The snapshot defines the ratios between the member volumes for the group volume change
+        coordinator.groupRenderingControl.SnapshotGroupVolume([('InstanceID', 0)])
+        result = coordinator.groupRenderingControl.SetRelativeGroupVolume([
+            ('InstanceID', 0), 
+            ('Adjustment', volumeDelta)])
+        newGroupVol = int(result['NewVolume'])
+        
+        # The group volume is the average of the member volumes, which keep their ratios: Estimate them
+        # (so that the next change needs no query), the next events giving the actual values
+        groupVol = float(sum(volumes)) / len(volumes)
+        for sp, vol in zip(members, volumes):
+            if groupVol > 0:
+                newVol = int(round(vol * newGroupVol / groupVol))
+            else:
+                newVol = newGroupVol
+            self.stateCache.setVolume(sp, max(0, min(100, newVol)))
+        return newGroupVol
+    
+    def adjustMemberVolume(self, sp, volumeDelta):
+        oldVol = None
+        newVol = None
+        try:
+            oldVol = self.getVolume(sp)
+            newVol = oldVol + volumeDelta
+            
+            # Enforce volume limits
+            if newVol < self.minVolume:
+                self.logger.debug("Upping volume to {:d} [would have been {:d}]".format(self.minVolume, newVol))
+                newVol = self.minVolume
+            elif newVol > self.maxVolume:
+                self.logger.debug("Limiting volume to {:d} [would have been {:d}]".format(self.maxVolume, newVol))
+                newVol = self.maxVolume
+            if newVol != oldVol:
+                self.setVolume(sp, newVol)
+            return True
         except:
-            self.logger.error("Problem adjusting volume (old volume: {:d}, new volume: {:d}, delta: {:d})".format(oldVol, newVol, volumeDelta))
+            self.logger.error("Problem adjusting volume for speaker {} (old volume: {}, new volume: {}, delta: {:d})".format(sp.ip_address, oldVol, newVol, volumeDelta))
+            return False
 
     def soundCheck(self, room):
         try:
             targetSp = self.getSpeaker(room)
-            for sp in targetSp.group.members:
-                vol = -1
-                newVol = -1
-                try:
-                    vol = sp.volume
-                    
-                    # Enforce volume limits
-                    if vol < self.minVolume:
-                        self.logger.debug("Upping volume to {:d} [would have been {:d}]".format(self.minVolume, newVol))
-                        sp.volume = self.minVolume
-                    elif vol > self.maxVolume:
-                        self.logger.debug("Limiting volume to {:d} [would have been {:d}]".format(self.maxVolume, newVol))
-                        sp.volume = self.maxVolume
-                    newVol = sp.volume
-                except:
-                    self.logger.error("Problem adjusting volume for room {} (old volume: {:d}, new volume: {:d})".format(sp.player_name, vol, newVol))
+            self.forEachMember(list(self.speakerMembers), self.checkMemberVolume)
+        except:
+            self.logger.error("Problem checking volume for room {}".format(room))
+            
+    def checkMemberVolume(self, sp):
+        vol = -1
+        newVol = -1
+        try:
+            vol = self.getVolume(sp)
+            newVol = vol
+            
+            # Enforce volume limits
+            if vol < self.minVolume:
+                newVol = self.minVolume
+                self.logger.debug("Upping volume to {:d} [would have been {:d}]".format(newVol, vol))
+            elif vol > self.maxVolume:
+                newVol = self.maxVolume
+                self.logger.debug("Limiting volume to {:d} [would have been {:d}]".format(newVol, vol))
+            if newVol != vol:
+                self.setVolume(sp, newVol)
         except:
-            self.logger.error("Problem adjusting volume (old volume: {:d}, new volume: {:d})".format(vol, newVol))
+            self.logger.error("Problem adjusting volume for speaker {} (old volume: {:d}, new volume: {:d})".format(sp.ip_address, vol, newVol))
+    
+    # Apply a function to each group member, concurrently if there are several members.
+    # Returns the results in the order of the members
+    def forEachMember(self, members, function):
+        if len(members) == 1:
+            return [function(members[0])]
+        
+        if self.memberPool is None:
+            self.memberPool = ThreadPool(self.memberPoolSize)
+        return self.memberPool.map(function, members)
 
     def isCurrentlyPlaying(self, room):
         try:
             currentState = None
             sp = self.getSpeaker(room)
-            currentState = sp.get_current_transport_info()[u'current_transport_state']
+            currentState = self.getTransportState(sp)
             
             return currentState == 'PLAYING'
         
@@ -271,89 +676,167 @@ class SonosInterface(PlayerInterface):
             self.logger.error("Problem toggling play/pause (current state: {})".format(currentState))
             return False
             
-    # Reads the details of a given playlist and save those to a file
-    def exportPlaylistDetails(self, playlistName, room, archiveDir=None, overwrite=False):
+    # Reads the details of a given playlist and save those to the playlist store
+    # (by browsing the saved Sonos playlist, or, with useQueue, by playing it from the queue).
+    # When overwriting, the playlist is only fetched again if its Sonos update ID has changed,
+    # and only rewritten if its content differs (unless force is set).
+    # Returns False in case of problems.
+    def exportPlaylistDetails(self, playlistName, room, archiveDir=None, overwrite=False, useQueue=False, 
+                              sonosPlaylist=None, force=False):
         self.logger.debug("exportPlaylistDetails")
         
         try:
+            store = self.playlistStore
+            
             # Check whether the playlist has already been exported
-            if not overwrite and os.path.isfile(u'playlists/{}.json'.format(playlistName)):
+            if not overwrite and store.hasPlaylist(playlistName):
                 self.logger.debug(u'Playlist {} has already been exported: Skipping'.format(playlistName))
-                return
+                return True
 
             sp = self.getSpeaker(room)
             
-            # Clear queue to start with an empty state
-            sp.clear_queue()
-            
             # Find playlist
-            sonosPlaylist = sp.get_sonos_playlist_by_attr('title', playlistName)
-
-            # Enqueue tracks
-            sp.add_to_queue(sonosPlaylist)
+            if sonosPlaylist is None:
+                sonosPlaylist = sp.get_sonos_playlist_by_attr('title', playlistName)
             
-            # Figure out how many items there are in the queue
-            queueSize = int(sp.queue_size)
+            # Skip playlists which have not changed since the last export
+            syncInfo = store.getSyncInfo(playlistName)
+            updateId = self.getContainerUpdateId(sp, sonosPlaylist)
+            if not force and updateId is not None and syncInfo.get(u'updateId') == updateId:
+                self.logger.debug(u'Playlist {} unchanged (update ID {}): Skipping'.format(playlistName, updateId))
+                return True
+            
+            if useQueue:
+                playlist = self.readPlaylistFromQueue(sp, sonosPlaylist, playlistName)
+            else:
+                playlist = self.readPlaylistFromLibrary(sp, sonosPlaylist, playlistName)
             
-            self.logger.debug(u'Playlist {} ({:d} items)'.format(playlistName, queueSize))
+            self.logger.debug(u'Playlist {} ({:d} items)'.format(playlistName, len(playlist.tracks)))
             
-            if queueSize > 0:
-                playlist = Playlist(playlistName)
+            if len(playlist.tracks) > 0:
+                contentHash = playlist.contentHash()
+                if not force and syncInfo.get(u'hash') == contentHash:
+                    self.logger.debug(u'Playlist {} has the same content as the exported one: Not rewriting'.format(playlistName))
+                    store.setSyncInfo(playlistName, updateId, contentHash)
+                else:
+                    store.savePlaylist(playlist, updateId, contentHash)
+                    self.uriIndex.resolveAll(track.uri for track in playlist.tracks)
+                    self.uriIndex.save()
+                    if archiveDir is not None:
+                        self.archivePlaylists(archiveDir)
                 
-                sp.play()
-                sp.pause()
+            return True
+        except:
+            self.logger.error("Problem exporting playlist details for '{}'".format(playlistName))
+            return False
+        
+    # Update ID of a Sonos container (changes whenever its content changes); None if not available
+    def getContainerUpdateId(self, sp, container):
+        try:
+            response = sp.contentDirectory.Browse([
+                ('ObjectID', container.item_id),
+                ('BrowseFlag', 'BrowseMetadata'),
+                ('Filter', '*'),
+                ('StartingIndex', 0),
+                ('RequestedCount', 1),
+                ('SortCriteria', '')])
+            return u'{}'.format(response['UpdateID'])
+        except:
+            self.logger.debug(u'No update ID available for {}'.format(container.item_id))
+            return None
+    
+    # Keep a copy of the playlist store as playlists/archive/<archiveName>.db
+    def archivePlaylists(self, archiveName):
+        try:
+            os.makedirs(u'playlists/archive')
+        except OSError:
+            pass
+        self.playlistStore.backup(u'playlists/archive/{}.db'.format(archiveName))
+        
+    # Convert a Sonos track uri (x-file-cifs://server/share/path, url-encoded) to //server/share/path
+    def sonosUriToPath(self, uri):
+        return self.uriIndex.fromSonosUri(uri)
+        
+    # Read the items of a saved Sonos playlist with paged ContentDirectory browse calls 
+    # (leaves the queue and the current playback untouched)
+    def readPlaylistFromLibrary(self, sp, sonosPlaylist, playlistName):
+        playlist = Playlist(playlistName)
+        
+        start = 0
+        while True:
+            response = sp.contentDirectory.Browse([
+                ('ObjectID', sonosPlaylist.item_id),
+                ('BrowseFlag', 'BrowseDirectChildren'),
+                ('Filter', '*'),
+                ('StartingIndex', start),
+                ('RequestedCount', self.browsePageSize),
+                ('SortCriteria', '')])
+            
+            items = from_didl_string(response['Result'])
+            for index, item in enumerate(items):
+                trackNb = start + index + 1
+                uri = self.sonosUriToPath(item.resources[0].uri)
+                playlist.addTrack(trackNb, getattr(item, 'creator', u''), getattr(item, 'album', u''), item.title, uri)
+            
+            returned = int(response['NumberReturned'])
+            start += returned
+            if returned == 0 or start >= int(response['TotalMatches']):
+                break
+            
+        return playlist
+        
+    # Read the items of a saved Sonos playlist by enqueuing it and skipping through all tracks
+    # (clears the queue of the speaker)
+    def readPlaylistFromQueue(self, sp, sonosPlaylist, playlistName):
+        playlist = Playlist(playlistName)
+        
+        # Clear queue to start with an empty state
+        sp.clear_queue()
+        
+        # Enqueue tracks
+        sp.add_to_queue(sonosPlaylist)
+        
+        # Figure out how many items there are in the queue
+        queueSize = int(sp.queue_size)
+        
+        if queueSize > 0:
+            sp.play()
+            sp.pause()
+            
+            # Retrieve track info for each item in the queue
+            itemNb = 0
+            while itemNb < queueSize:
+                info = sp.get_current_track_info()
+                itemNb = int(info[u'playlist_position'])
+                artist = info[u'artist']
+                title = info[u'title']
+                album = info[u'album']
+                uri = self.sonosUriToPath(info[u'uri'])
                 
-                # Retrieve track info for each item in the queue
-                itemNb = 0
-                while itemNb < queueSize:
-                    info = sp.get_current_track_info()
-                    itemNb = int(info[u'playlist_position'])
-                    artist = info[u'artist']
-                    title = info[u'title']
-                    album = info[u'album']
-                    uri = info[u'uri']
-                    uri = urllib.unquote(uri).decode("utf-8")
-                    uri = uri.replace(u'x-file-cifs:', u'')
-                    
-                    self.logger.debug(u"    {:d} Artist: {}".format(itemNb, artist))
-                    self.logger.debug(u"    {:d} Album: {}".format(itemNb, album))
-                    self.logger.debug(u"    {:d} Title: {}".format(itemNb, title))
-                    self.logger.debug(u"    {:d} URI: {}".format(itemNb, uri))
-                    
-                    playlist.addTrack(itemNb, artist, album, title, uri)
-                    
-                    try:
-                        sp.next()
-                    except:
-                        break
-                    
-    #             json = playlist.toJSON()
+                self.logger.debug(u"    {:d} Artist: {}".format(itemNb, artist))
+                self.logger.debug(u"    {:d} Album: {}".format(itemNb, album))
+                self.logger.debug(u"    {:d} Title: {}".format(itemNb, title))
+                self.logger.debug(u"    {:d} URI: {}".format(itemNb, uri))
                 
-                sp.stop()
+                playlist.addTrack(itemNb, artist, album, title, uri)
                 
                 try:
-                    os.mkdir(u'playlists')
-                except OSError:
-                    pass
-                 
-                playlist.writeToFile(u'playlists/{}.json'.format(playlistName))
-                if archiveDir is not None:
-                    try:
-                        os.mkdir(u'playlists/{}'.format(archiveDir))
-                    except OSError:
-                        pass
-                    playlist.writeToFile(u'playlists/{}/{}.json'.format(archiveDir, playlistName))
-                    
-    #             self.logger.debug(u'JSON: {}'.format(json))
-                
-            # Clean up
-            sp.clear_queue()
-        except:
-            self.logger.error("Problem exporting playlist details for '{}'".format(playlistName))
-            return
+                    sp.next()
+                except:
+                    break
+            
+            sp.stop()
+            
+        # Clean up
+        sp.clear_queue()
+        
+        return playlist
 
-    # Reads the details of all playlists and save those to json files
-    def exportAllPlaylists(self, room, overwrite=False):
+    # Reads the details of all playlists and save those to the playlist store, in a single transaction
+    # (with overwrite, only the playlists changed since the last export are fetched and rewritten;
+    # force re-exports all of them). progress(fraction) is called after each playlist; 
+    # the export stops early once cancel() returns True
+    def exportAllPlaylists(self, room, overwrite=False, force=False, progress=None, cancel=None):
         self.logger.debug("exportAllPlaylists")
         try:
                 
@@ -363,11 +846,51 @@ class SonosInterface(PlayerInterface):
             room = u'Office'
             playlistBasename = u'zCharliebert_'
             
+            playlistNames = []
             for bank in (u'A', u'B', u'C', u'D'):
                 for kind in (u'', u'_alt'):
                     for nb in range(1, 13):             
-                        playlistName = u'{}{}{:02d}{}'.format(playlistBasename, bank, nb, kind)
-                        self.exportPlaylistDetails(playlistName, room, archiveDir, overwrite)
+                        playlistNames.append(u'{}{}{:02d}{}'.format(playlistBasename, bank, nb, kind))
+            
+            sp = self.getSpeaker(room)
+            
+            # List all Sonos playlists at once (instead of searching them one by one)
+            sonosPlaylists = sp.get_sonos_playlists(complete_result=True)
+            sonosPlaylistsByTitle = dict((p.title, p) for p in sonosPlaylists)
+            updateId = getattr(sonosPlaylists, 'update_id', None)
+            if updateId is not None:
+                updateId = u'{}'.format(updateId)
+            
+            # Nothing to do if no Sonos playlist has changed since the last complete export
+            store = self.playlistStore
+            if overwrite and not force and updateId is not None and store.getSyncState(playlistBasename) == updateId \
+            and all(store.hasPlaylist(name) for name in playlistNames if name in sonosPlaylistsByTitle):
+                self.logger.debug(u'Sonos playlists unchanged (update ID {}): Nothing to export'.format(updateId))
+                return
+            
+            nbSaved = store.nbSaved
+            with store.transaction():
+                success = True
+                for index, playlistName in enumerate(playlistNames):
+                    if cancel is not None and cancel():
+                        self.logger.info(u'Export canceled')
+                        success = False
+                        break
+                    if progress is not None:
+                        progress(float(index) / len(playlistNames))
+                    if playlistName not in sonosPlaylistsByTitle:
+                        self.logger.debug(u'Playlist {} does not exist: Skipping'.format(playlistName))
+                        continue
+                    if not self.exportPlaylistDetails(playlistName, room, None, overwrite, 
+                                                      sonosPlaylist=sonosPlaylistsByTitle[playlistName], force=force):
+                        success = False
+                
+                if success and updateId is not None:
+                    store.setSyncState(playlistBasename, updateId)
+                    
+            # Archive the playlists once, if any has changed
+            if store.nbSaved > nbSaved:
+                self.archivePlaylists(archiveDir)
         except:
             self.logger.error("Problem exporting playlists")
 
@@ -0,0 +1,89 @@
+# Check SonosStateCache against a stand-in for the soco event listener (no speaker needed):
+# python tests/sonosEvents.py
+import os
+import sys
+import time
+import logging
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sonosInterface import SonosStateCache
+
+
+class Event:
+    def __init__(self, sid, variables):
+        self.sid = sid
+        self.variables = variables
+
+class Subscription:
+    def __init__(self, sid):
+        self.sid = sid
+        self.is_subscribed = True
+    def unsubscribe(self):
+        self.is_subscribed = False
+
+class Service:
+    def __init__(self, name):
+        self.name = name
+
+class Speaker:
+    def __init__(self, ip_address):
+        self.ip_address = ip_address
+        self.avTransport = Service('AVTransport')
+        self.renderingControl = Service('RenderingControl')
+
+# Wait until the cache thread has processed the events put so far
+def waitForEvents(cache):
+    while not cache.events.empty():
+        time.sleep(0.01)
+    time.sleep(0.05)
+
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger('sonosEvents')
+
+subscriptions = []
+def subscribe(service):
+    subscription = Subscription('uuid:{:d}'.format(len(subscriptions)))
+    subscriptions.append(subscription)
+    return subscription
+
+coordinator = Speaker('192.168.1.10')
+member = Speaker('192.168.1.11')
+cache = SonosStateCache(logger, subscribe=subscribe, unwatchedMaxAge=0.2)
+cache.watch(coordinator, [coordinator, member])
+assert len(subscriptions) == 3
+
+# Events update the cached values
+cache.events.put(Event('uuid:0', {u'transport_state': u'PLAYING'}))
+cache.events.put(Event('uuid:2', {u'volume': {u'Master': u'23', u'LF': u'100'}}))
+cache.events.put(Event('uuid:unknown', {u'volume': {u'Master': u'99'}}))
+waitForEvents(cache)
+assert cache.getTransportState(coordinator) == u'PLAYING'
+assert cache.getVolume(member) == 23
+assert cache.getVolume(coordinator) is None
+
+# Watched values are kept; values of a lapsed subscription expire quickly
+subscriptions[2].is_subscribed = False
+time.sleep(0.3)
+assert cache.getTransportState(coordinator) == u'PLAYING'
+assert cache.getVolume(member) is None
+
+# Without subscriptions, values set after querying the speakers expire quickly too
+cache.unsubscribeAll()
+assert all(not subscription.is_subscribed for subscription in subscriptions)
+cache.setTransportState(coordinator, u'PAUSED_PLAYBACK')
+assert cache.getTransportState(coordinator) == u'PAUSED_PLAYBACK'
+time.sleep(0.3)
+assert cache.getTransportState(coordinator) is None
+
+# Failed subscription: Nothing watched
+def failingSubscribe(service):
+    raise RuntimeError('no event listener')
+failingCache = SonosStateCache(logger, subscribe=failingSubscribe, unwatchedMaxAge=0.2)
+failingCache.watch(coordinator, [coordinator])
+failingCache.setVolume(coordinator, 40)
+time.sleep(0.3)
+assert failingCache.getVolume(coordinator) is None
+
+cache.stop()
+failingCache.stop()
+print("OK")
@@ -0,0 +1,72 @@
+import os
+import re
+import threading
+import urllib
+
+
+# Resolution of track URIs (//server/share/path, as exported from Sonos) to the SMB location
+# of the file and its path in the local MPD library: (server, share, path, localPath).
+# Entries are computed once and kept in the playlist store (if given), so that copying files
+# and defining playlists need no parsing per track.
+class UriIndex:
+    uriParser = re.compile(u'//([^/]+)/([^/]+)/(.+)\s*$')
+
+    def __init__(self, store=None, localRoot=u'music', logger=None):
+        self.store = store
+        self.localRoot = localRoot
+        self.logger = logger
+        self.lock = threading.Lock()
+
+        # {uri: (server, share, path, localPath)}
+        self.entries = {}
+        # Entries not saved in the store yet
+        self.newEntries = {}
+        # {Sonos uri: uri}
+        self.sonosUris = {}
+
+        if self.store is not None:
+            self.entries.update(self.store.getUriEntries())
+
+    # (server, share, path) from an uri, the server being reached through mDNS
+    @classmethod
+    def parse(cls, uri):
+        m = cls.uriParser.search(uri)
+        if m is None:
+            raise ValueError(u'Unrecognized uri {}'.format(uri))
+        return (u'{}.local'.format(m.group(1)), m.group(2), m.group(3))
+
+    def resolve(self, uri):
+        entry = self.entries.get(uri)
+        if entry is None:
+            (server, share, path) = self.parse(uri)
+            entry = (server, share, path, os.path.join(self.localRoot, path))
+            with self.lock:
+                self.entries[uri] = entry
+                self.newEntries[uri] = entry
+        return entry
+
+    def resolveAll(self, uris):
+        for uri in uris:
+            try:
+                self.resolve(uri)
+            except ValueError as e:
+                if self.logger is not None:
+                    self.logger.error(u'{}'.format(e))
+
+    # Convert a Sonos track uri (x-file-cifs://server/share/path, url-encoded) to //server/share/path
+    def fromSonosUri(self, sonosUri):
+        uri = self.sonosUris.get(sonosUri)
+        if uri is None:
+            encoded = sonosUri.encode('utf-8') if isinstance(sonosUri, unicode) else sonosUri
+            uri = urllib.unquote(encoded).decode('utf-8').replace(u'x-file-cifs:', u'')
+            self.sonosUris[sonosUri] = uri
+        return uri
+
+    def save(self):
+        if self.store is None:
+            return
+        with self.lock:
+            entries = self.newEntries
+            self.newEntries = {}
+        if entries:
+            self.store.saveUriEntries(entries)
@@ -2,21 +2,36 @@
 import RPi.GPIO as GPIO 
 from collections import deque
 import threading
-from time import sleep
 import time
 import logging
 from logging.handlers import RotatingFileHandler
-from distutils.cmd import Command
 import smbus
-import re
+from mcp23017 import Mcp23017
+from ledAnimation import LedAnimation, BlinkAll, BlinkOne, ProgressBar
+try:
+    import Queue as Q # For python 2
+except:
+    import queue as Q # For python 3
+from commands import PlayPause, Forward, Back, StartPlaylist, StartAltPlaylist, PlayTrack, AdjustVolume, \
+    Shutdown, RunCommand, SelectRoom, SelectNetwork, SetNetworkAndRoom, Progress, Diagnostics
     
     
 class UserInterface:
     
-    def __init__(self, logger):
+    # mcpInterruptPort: GPIO port connected to the INTB line of the MCP (None: No interrupts)
+    def __init__(self, logger, mcpInterruptPort=4):
         self.logger = logger
+        self.mcpInterruptPort = mcpInterruptPort
         self.logger.info("Initializing instance of UserInterface")
         
+        # Wakes up the main loop: Set by the interrupts, the commands from the player interface
+        # and the stopper (the loop otherwise only wakes up for the next led animation step)
+        self.wake = threading.Event()
+        # Period (s) for checking the mode switch while alt-mode is on
+        self.altModeCheckPeriod = 0.1
+        # Longest sleep of the main loop (s)
+        self.maxWaitPeriod = 1.0
+
         # GPIO settings
         GPIO.setwarnings(True)
         GPIO.setmode(GPIO.BCM)
@@ -48,37 +63,30 @@ class UserInterface:
         self.switchOffCurrentNbOperations = 0
         self.activateAltModeCurrentNbOperations = 0
                 
-        # Indicator for shift mode: if true, blink all bank leds
-        self.blinking = False
-        # Indicator for alt/playlist mode: if true, blink the current bank led
-        self.blinkingOne = False
         # Period for blinking leds (in seconds)
         self.blinkPeriod = 0.5
         
-        # Progress indicator: Cycle through all speaker leds while completing a task
-        self.cyclingSpeakerLeds = False
+        # Progress indicator: Show the progress with the speaker leds while completing a task
         self.progress = False
+        # Progress (in percent) of the task, if known
+        self.progressPercent = None
         
         # SMBUS stuff for additional ports via MCP23017 chip
         self.initMcp()
         self.currentRoomNb = None
         self.currentNetworkNb = None
-        self.codeForCyclingSpeakerLeds = None
+
+        # Led animations
+        self.initAnimations()
 
         # Parser for the p2u queue
-        self.parser = re.compile("^([A-Z/]+)(\s+([A-Z]+))*(\s+([-0-9]+))*(\s*;\s+([-0-9]+))*\s*$")
+        # Handlers of the commands from the player interface
+        self.handlers = {SetNetworkAndRoom: self.setNetworkAndRoom,
+                         Progress: self.setProgress,
+                         Diagnostics: self.logDiagnostics}
 
         
     def initMcp(self):
-        self.mcpDeviceAddress = 0x20
-        self.mcpAddressMap = {
-    0x00: 'IODIRA', 0x01: 'IODIRB', 0x02: 'IPOLA', 0x03: 'IPOLB',
-    0x04: 'GPINTENA', 0x05: 'GPINTENB', 0x06: 'DEFVALA', 0x07: 'DEVFALB',
-    0x08: 'INTCONA', 0x09: 'INTCONB', 0x0a: 'IOCON', 0x0b: 'IOCON',
-    0x0c: 'GPPUA', 0x0d: 'GPPUB', 0x0e: 'INTFA', 0x0f: 'INTFB',
-    0x10: 'INTCAPA', 0x11: 'INTCAPB', 0x12: 'GPIOA', 0x13: 'GPIOB',
-    0x14: 'OLATA', 0x15: 'OLATB'}
-        self.mcpRegisterMap = {value: key for key, value in self.mcpAddressMap.iteritems()}
         # First 6 bits
         self.roomNbMap = {
                         0x3B: 1, 0x37: 2, 0x2F: 3, 0x1F: 4, 0x3E: 5, 0x3D: 6
@@ -89,50 +97,123 @@ class UserInterface:
                         }
         
         # Define device
-        self.mcpBus = smbus.SMBus(1)
+        self.mcp = Mcp23017(smbus.SMBus(1), 0x20, self.logger)
+        # IOCON: BANK = 0 (register addresses used by Mcp23017), MIRROR = 0 (INTB only reflects port B),
+        # SEQOP = 0 (sequential reads), ODR = 0 and INTPOL = 0 (INTB driven, active low)
+        self.mcp.write('IOCON', 0x00)
         # Set pullup resistors
-        self.mcpBus.write_byte_data(self.mcpDeviceAddress, self.mcpRegisterMap['GPPUA'], 0xFF)
-        self.mcpBus.write_byte_data(self.mcpDeviceAddress, self.mcpRegisterMap['GPPUB'], 0xFF)
+        self.mcp.write('GPPUA', 0xFF)
+        self.mcp.write('GPPUB', 0xFF)
         # Set direction (input) 
-        self.mcpBus.write_byte_data(self.mcpDeviceAddress, self.mcpRegisterMap['IODIRA'], 0x00)
-        self.mcpBus.write_byte_data(self.mcpDeviceAddress, self.mcpRegisterMap['IODIRB'], 0xFF)
+        self.mcp.write('IODIRA', 0x00)
+        self.mcp.write('IODIRB', 0xFF)
+
+        self.mcp.write('GPIOA', 0x00, force=True)
+
+        # Room/network selectors (port B): Snapshot updated upon interrupts from the MCP, so that
+        # reading them costs no I2C transaction (None: Interrupts not available, read port B directly)
+        self.mcpInputs = None
+        # The snapshot is checked against port B every mcpReconcilePeriod seconds: After
+        # mcpMaxMissedInterrupts changes without interrupt, the INTB line is considered dead
+        self.mcpReconcilePeriod = 5.0
+        self.mcpMaxMissedInterrupts = 3
+        self.mcpMissedInterrupts = 0
+        self.mcpReconcileTime = time.time()
+        if self.mcpInterruptPort is None:
+            self.logger.debug("No interrupt line for the MCP: Reading the room & network selectors on demand")
+            return
+        try:
+            # Interrupt on any change of port B (compared with the previous value)
+            self.mcp.write('INTCONB', 0x00)
+            self.mcp.write('GPINTENB', 0xFF)
+            GPIO.setup(self.mcpInterruptPort, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+            # Reading port B also clears any pending interrupt
+            self.mcpInputs = self.mcp.read('GPIOB')
+            # The line must then be back to its idle level (high); an unconnected line (pulled up)
+            # is only detected by reconcileMcpInputs
+            if GPIO.input(self.mcpInterruptPort) != GPIO.HIGH:
+                self.logger.error("INTB line of the MCP (port {:d}) stuck low: Reading the room & network selectors on demand".format(self.mcpInterruptPort))
+                self.disableMcpInterrupts()
+                return
+            GPIO.add_event_detect(self.mcpInterruptPort, GPIO.FALLING, callback=self.callbackMcp)
+        except:
+            self.logger.error("Cannot set up interrupts from the MCP: Reading the room & network selectors on demand")
+            self.disableMcpInterrupts()
+
+    def disableMcpInterrupts(self):
+        self.mcpInputs = None
+        try:
+            self.mcp.write('GPINTENB', 0x00)
+            GPIO.remove_event_detect(self.mcpInterruptPort)
+        except:
+            pass
 
-        self.mcpBus.write_byte_data(self.mcpDeviceAddress, self.mcpRegisterMap['GPIOA'], 0x00)
+    # Check the snapshot of the selectors from time to time, in case an interrupt was missed
+    # (line not wired, or edge missed while INTB stayed low: Reading port B releases it)
+    def reconcileMcpInputs(self):
+        snapshot = self.mcpInputs
+        if snapshot is None or time.time() - self.mcpReconcileTime < self.mcpReconcilePeriod:
+            return
+        self.mcpReconcileTime = time.time()
+        try:
+            current = self.readMcp('GPIOB')
+        except:
+            self.logger.error("Error reading the room & network selectors")
+            return
+        # Not updated by an interrupt meanwhile
+        if current == snapshot or self.mcpInputs != snapshot:
+            return
+        
+        self.mcpMissedInterrupts += 1
+        self.logger.error("MCP port B changed without interrupt (0x{:02X} -> 0x{:02X}, {:d} times)".format(snapshot, current, self.mcpMissedInterrupts))
+        self.mcpInputs = current
+        if self.mcpMissedInterrupts >= self.mcpMaxMissedInterrupts:
+            self.logger.error("INTB line of the MCP (port {:d}) seems dead: Reading the room & network selectors on demand".format(self.mcpInterruptPort))
+            self.disableMcpInterrupts()
     
     def endMcp(self):
         # Switch leds off
-        self.mcpBus.write_byte_data(self.mcpDeviceAddress, self.mcpRegisterMap['GPIOA'], 0x00)
+        self.mcp.write('GPIOA', 0x00, force=True)
+        # Disable interrupts
+        if self.mcpInterruptPort is not None:
+            self.mcp.write('GPINTENB', 0x00)
+        self.logger.debug("MCP transactions: {}".format("; ".join(self.mcp.getStats())))
+
+    # Interrupt from the MCP: A room/network selector has changed
+    def callbackMcp(self, channel):
+        try:
+            # State of port B when the interrupt occurred (reading it clears the interrupt), and its
+            # current state: Changes occurring while the interrupt was pending raise no new interrupt
+            # (INTCAPB, GPIOA, GPIOB read in a single transaction)
+            (sw, _, current) = self.mcp.readBlock('INTCAPB', 3)
+            if current != sw:
+                self.logger.debug("MCP port B changed again since the interrupt (0x{:02X} -> 0x{:02X})".format(sw, current))
+            self.mcpInputs = current
+        except:
+            self.logger.error("Error reading the room & network selectors upon interrupt")
+            # Read port B directly until the next interrupt
+            self.mcpInputs = None
+        # Let the main loop handle the change right away (instead of at its next timeout)
+        self.wake.set()
+
+    # State of the room/network selectors (port B)
+    def getMcpInputs(self):
+        sw = self.mcpInputs
+        if sw is None:
+            sw = self.readMcp('GPIOB')
+        return sw
 
     def readMcp(self, reg):
-        #self.logger.debug("readMcp for reg = {}".format(reg))
-        if reg in self.mcpRegisterMap:
-            try:
-                #self.logger.debug("readMcp: reg = {} exists".format(reg))
-                return self.mcpBus.read_byte_data(self.mcpDeviceAddress, self.mcpRegisterMap[reg])
-            except:
-                #self.logger.debug("readMcp: Cannot read data for reg = {}".format(reg))
-                raise
-        else:
-            #self.logger.debug("readMcp: reg = {} does not exist".format(reg))
-            raise
+        return self.mcp.read(reg)
         
+    # Returns False if the register already held the value (no transaction)
     def writeMcp(self, reg, sw):
-        #self.logger.debug("writeMcp for reg = {}, sw = {}".format(reg, sw))
-        if reg in self.mcpRegisterMap:
-            try:
-                #self.logger.debug("writeMcp: reg = {} exists".format(reg))
-                return self.mcpBus.write_byte_data(self.mcpDeviceAddress, self.mcpRegisterMap[reg], sw)
-            except:
-                #self.logger.debug("writeMcp: Cannot write data for reg = {}".format(reg))
-                raise
-        else:
-            #self.logger.debug("writeMcp: reg = {} does not exist".format(reg))
-            raise
+        return self.mcp.write(reg, sw)
         
     def getActiveRoomNb(self):
         #self.logger.debug("getActiveRoomNb")
         try:
-            sw = self.readMcp('GPIOB')
+            sw = self.getMcpInputs()
             # Apply mask (extract first 6 bits)
             sw = sw & 0x3F
             #self.logger.debug("sw = {}".format(sw))
@@ -145,7 +226,7 @@ class UserInterface:
     def getActiveNetworkNb(self):
         #self.logger.debug("getActiveNetworkNb")
         try:
-            sw = self.readMcp('GPIOB')
+            sw = self.getMcpInputs()
             # Apply mask (extract last 2 bits)
             sw = sw & 0xC0
             #self.logger.debug("sw = {}".format(sw))
@@ -186,30 +267,6 @@ class UserInterface:
         except:
             self.logger.error("Error setting the room & network leds")
 
-    def cycleSpeakerLeds(self):
-        #self.logger.debug("cycleSpeakerLeds")
-        try:
-            if self.codeForCyclingSpeakerLeds == 0x40:
-                self.codeForCyclingSpeakerLeds = 0x80
-            elif self.codeForCyclingSpeakerLeds == 0x80:
-                self.codeForCyclingSpeakerLeds = 0x10
-            elif self.codeForCyclingSpeakerLeds == 0x10:
-                self.codeForCyclingSpeakerLeds = 0x04
-            elif self.codeForCyclingSpeakerLeds == 0x04:
-                self.codeForCyclingSpeakerLeds = 0x08
-            elif self.codeForCyclingSpeakerLeds == 0x08:
-                self.codeForCyclingSpeakerLeds = 0x20
-            elif self.codeForCyclingSpeakerLeds == 0x20:
-                self.codeForCyclingSpeakerLeds = 0x40
-            else:
-                self.codeForCyclingSpeakerLeds = 0x40
-                
-            #self.logger.debug("self.codeForCyclingSpeakerLeds = {}".format(self.codeForCyclingSpeakerLeds))
-            self.writeMcp('GPIOA', self.codeForCyclingSpeakerLeds)
-        except:
-            self.logger.error("Error cycling the room leds")
-        
-    
     def initSwitches(self):
         # Switch numbers: {Port, Switch number}
         self.switchNbs = { 
@@ -352,6 +409,7 @@ class UserInterface:
             else:  # so depending on direction either
                 self.rotaryCounter -= 1  # increase or decrease counter
             self.rotaryLock.release()  # and release lock
+            self.wake.set()
 
     def processRotary(self):
         self.rotaryLock.acquire()  # get lock for rotary switch
@@ -367,7 +425,7 @@ class UserInterface:
             print("Volume change: {:d}; newCounter: {:d}; volume = {:d}".format(volumeDelta, self.newCounter, self.volume))  # some test print
             if self.u2pQueue is not None:
                 try:
-                    self.u2pQueue.put("VOLUME {:d}".format(volumeDelta))
+                    self.u2pQueue.put(AdjustVolume(volumeDelta))
                 except:
                     pass
                 
@@ -376,6 +434,8 @@ class UserInterface:
             self.incrementNbOperations()
                         
     def incrementNbOperations(self):
+        # Operations may change the mode shown by the leds: Let the main loop update them
+        self.wake.set()
         self.nbOperations += 1
         # Make sure the value does not grow too big
         if self.nbOperations > 100000:
@@ -460,7 +520,7 @@ class UserInterface:
             else:
                 changes = True
                 self.logger.debug("Actually changing the currently active room")
-                self.u2pQueue.put("ROOM {:d}".format(curRoomNb))
+                self.u2pQueue.put(SelectRoom(curRoomNb))
             
         # Check whether the active network has been changed:
         self.logger.debug("Checking whether the active network has changed")
@@ -473,7 +533,7 @@ class UserInterface:
             else:
                 changes = True
                 self.logger.debug("Actually changing the currently active network")
-                self.u2pQueue.put("NET {:d}".format(curNetworkNb))
+                self.u2pQueue.put(SelectNetwork(curNetworkNb))
 
         if changes:
             self.logger.debug("Changing the currently active speaker led indicator")
@@ -529,13 +589,13 @@ class UserInterface:
         if self.u2pQueue is not None:
             try:
                 if self.isAltModeOn():
-                    self.u2pQueue.put("TRACK {:d}".format(self.getSwitch(channel)))
+                    self.u2pQueue.put(PlayTrack(self.getSwitch(channel)))
                 elif self.isShiftModeOn():
-                    self.u2pQueue.put("COMMAND {:d}".format(self.getSwitch(channel)))
+                    self.u2pQueue.put(RunCommand(self.getSwitch(channel)))
                 elif self.isAltPlaylistModeOn():
-                    self.u2pQueue.put("ALTPLAYLIST {} {:d}".format(self.getBank(), self.getSwitch(channel)))
+                    self.u2pQueue.put(StartAltPlaylist(self.getBank(), self.getSwitch(channel)))
                 else:
-                    self.u2pQueue.put("PLAYLIST {} {:d}".format(self.getBank(), self.getSwitch(channel)))
+                    self.u2pQueue.put(StartPlaylist(self.getBank(), self.getSwitch(channel)))
             except:
                 pass
 
@@ -609,11 +669,11 @@ class UserInterface:
             if self.u2pQueue is not None:
                 try:
                     if self.switches[channel] == self.playSwitch and not self.isAltModeOn():
-                        self.u2pQueue.put("PLAY/PAUSE")
+                        self.u2pQueue.put(PlayPause())
                     elif self.switches[channel] == self.forwardSwitch and not self.isAltModeOn():
-                        self.u2pQueue.put("FORWARD")
+                        self.u2pQueue.put(Forward())
                     elif self.switches[channel] == self.backSwitch and not self.isAltModeOn():
-                        self.u2pQueue.put("BACK")
+                        self.u2pQueue.put(Back())
                 except:
                     pass
 
@@ -675,138 +735,106 @@ class UserInterface:
 
         if self.u2pQueue is not None:
             try:
-                self.u2pQueue.put("SHUTDOWN")
+                self.u2pQueue.put(Shutdown())
             except:
                 pass
         
-    # When shift mode is on, signal it by blinking all bank leds until a room is selected or play is pressed anew    
-    def blinkLedsForShift(self):
-        # Not in shift mode: Nothing to do
-        if not self.blinking and not self.isShiftModeOn():
-            return
-        
-        # Start blinking
-        if not self.blinking and self.isShiftModeOn():
-            self.blinking = True
-            # Switch on all leds
-            self.switchAllLeds(True)
-            self.blinkRefTime = time.time()
-            self.blinkState = True
-            return
-            
-        # Stop blinking
-        if self.blinking and not self.isShiftModeOn():
-            self.blinking = False
-            # Switch on only the led corresponding to the current bank 
-            self.incrementBank(False, True)
-            return
-            
-        # Continue blinking
-        if self.blinking and self.isShiftModeOn():
-            # Alternately switch on and off all leds
-            if time.time() - self.blinkRefTime >= self.blinkPeriod:
-                self.blinkRefTime = time.time()
-                self.blinkState = not self.blinkState
-                self.switchAllLeds(self.blinkState)
-                
-    # When alt-playlist mode is on, signal it by blinking the current bank led until a playlist is selected or forward is pressed anew    
-    def blinkLedsForAltPlaylist(self):
-        # Not in alt-playlist mode: Nothing to do
-        if not self.blinkingOne and not self.isAltPlaylistModeOn():
-            return
-        
-        # Start blinking
-        if not self.blinkingOne and self.isAltPlaylistModeOn():
-            self.blinkingOne = True
-            # Switch off all leds
-            self.switchAllLeds(False)
-            self.blinkRefTime = time.time()
-            self.blinkState = True
-            return
-            
-        # Stop blinking
-        if self.blinkingOne and not self.isAltPlaylistModeOn():
-            self.blinkingOne = False
-            # Switch on only the led corresponding to the current bank 
-            self.incrementBank(False, True)
-            return
-            
-        # Continue blinking
-        if self.blinkingOne and self.isAltPlaylistModeOn():
-            # Alternately switch on and off all leds
-            if time.time() - self.blinkRefTime >= self.blinkPeriod:
-                self.blinkRefTime = time.time()
-                self.blinkState = not self.blinkState
-                if self.blinkState:
-                    # Switch off all leds
-                    self.switchAllLeds(False)
-                else:
-                    # Switch on only the led corresponding to the current bank 
-                    self.incrementBank(False, True)                                      
-        
-    # When performing an action (e.g. syncing playlists), signal it by cycling all speaker leds until completion    
-    def cycleSpeakerLedsForProgress(self):
-        #self.logger.debug("cycleSpeakerLedsForProgress (cyclingSpeakerLeds: {}, progress: {})".format(self.cyclingSpeakerLeds, self.progress))
-        # Not in progress mode: Nothing to do
-        if not self.cyclingSpeakerLeds and not self.progress:
-            #self.logger.debug("cycleSpeakerLedsForProgress: Not active")
-            return
+    def initAnimations(self):
+        # Speaker leds (MCP port A), in the order used for cycling through them
+        self.speakerLedCodes = [0x40, 0x80, 0x10, 0x04, 0x08, 0x20]
+        self.ledAnimation = LedAnimation(self.logger, self.writeBankLeds, self.writeSpeakerLeds)
+        # When shift mode is on, signal it by blinking all bank leds until a room is selected or play is pressed anew    
+        self.shiftAnimation = BlinkAll("shift", self.blinkPeriod, len(self.ledPorts),
+                                       onStop=self.restoreBankLeds)
+        # When alt-playlist mode is on, signal it by blinking the current bank led until a playlist is selected or forward is pressed anew    
+        self.altPlaylistAnimation = BlinkOne("alt-playlist", self.blinkPeriod, len(self.ledPorts),
+                                             lambda: ord(self.getBank()) - 65,
+                                             onStop=self.restoreBankLeds)
+        # When performing an action (e.g. syncing playlists), signal it with the speaker leds until completion    
+        self.progressAnimation = ProgressBar("progress", self.blinkPeriod, self.speakerLedCodes,
+                                             lambda: self.progressPercent,
+                                             onStart=self.startProgressAnimation,
+                                             onStop=self.restoreSpeakerLeds,
+                                             onFrame=self.preventShutdown)
+
+    # Start/stop the animations according to the current modes and show the frames which are due
+    def updateLeds(self):
+        self.ledAnimation.setActive(self.shiftAnimation, self.isShiftModeOn())
+        self.ledAnimation.setActive(self.altPlaylistAnimation, self.isAltPlaylistModeOn())
+        self.ledAnimation.setActive(self.progressAnimation, self.progress)
+        self.ledAnimation.update()
+
+    def writeBankLeds(self, states):
+        for l, state in zip(self.ledPorts, states):
+            GPIO.output(l, GPIO.HIGH if state else GPIO.LOW)
+
+    def writeSpeakerLeds(self, code):
+        try:
+            self.writeMcp('GPIOA', code)
+        except:
+            self.logger.error("Error setting the speaker leds")
 
-        # Stop cycling
-        if self.cyclingSpeakerLeds and not self.progress:
-            self.cyclingSpeakerLeds = False
-            # Switch on only the led corresponding to the current room/network 
-            self.logger.debug("Cycling over: Switching on leds for network {} and room {}".format(self.currentNetworkNb, self.currentRoomNb))
-            self.setActiveSpeakerLeds(self.currentNetworkNb, self.currentRoomNb)
-            return
-            
-        # Start cycling
-        if not self.cyclingSpeakerLeds and self.progress:
-            self.currentNetworkNb = self.getActiveNetworkNb()
-            self.logger.debug("Activating alt-mode: Current room number is {:d}, network number is {:d}".format(self.currentRoomNb, self.currentNetworkNb))
-            self.logger.debug("Cycling starting (current network {} and room {})".format(self.currentNetworkNb, self.currentRoomNb))
-            self.cyclingSpeakerLeds = True
-            self.blinkRefTime = time.time()
-            self.cycleSpeakerLeds()
-           
-        # Continue cycling
-        if self.cyclingSpeakerLeds and self.progress:
-            # Cycle through all speaker leds
-            #self.logger.debug("cycleSpeakerLedsForProgress: Loop")
-            if time.time() - self.blinkRefTime >= self.blinkPeriod:
-                self.logger.debug("cycleSpeakerLedsForProgress: Switch on next led")
-                self.blinkRefTime = time.time()
-                self.cycleSpeakerLeds()
-		# Prevent shutdown while completing a task
-		if self.reset is not None:
-		    self.reset.set()
+    def restoreBankLeds(self):
+        # Switch on only the led corresponding to the current bank 
+        self.incrementBank(False, True)
+
+    def startProgressAnimation(self):
+        self.currentNetworkNb = self.getActiveNetworkNb()
+        self.logger.debug("Progress animation starting (current network {} and room {})".format(self.currentNetworkNb, self.currentRoomNb))
+
+    def restoreSpeakerLeds(self):
+        # Switch on only the led corresponding to the current room/network 
+        self.logger.debug("Progress animation over: Switching on leds for network {} and room {}".format(self.currentNetworkNb, self.currentRoomNb))
+        self.setActiveSpeakerLeds(self.currentNetworkNb, self.currentRoomNb)
+
+    # Prevent shutdown while completing a task
+    def preventShutdown(self):
+        if self.reset is not None:
+            self.reset.set()
                 
+    # Execute all pending commands from the player interface
     def processCommands(self):
-        if not self.p2uQueue.empty():
-            command = self.p2uQueue.get(False)
-
-            # Process commands using the following mini-parser
-            m = self.parser.match(command)
+        if self.p2uQueue is None:
+            return
+        while True:
             try:
-                if m.group(1) == "NETWORK/ROOM":
-                    networkIndex = int(m.group(5))
-                    roomIndex = int(m.group(7))
-                    self.logger.debug("Command NETWORK ({:d}) / ROOM ({:d})".format(networkIndex, roomIndex))
-                    self.setActiveSpeakerLeds(networkIndex, roomIndex)
-                elif m.group(1) == "PROGRESS":
-                    if (m.group(3) == "START"):
-                        self.logger.debug("Command PROGRESS START")
-                        self.progress = True
-                        self.logger.debug("self.progress: {}".format(self.progress))
-                    elif (m.group(3) == "STOP"):
-                        self.logger.debug("Command PROGRESS STOP")
-                        self.progress = False
-                        self.logger.debug("self.progress: {}".format(self.progress))
-                else:
-                   raise 
+                command = self.p2uQueue.get(False)
+            except Q.Empty:
+                return
+
+            handler = self.handlers.get(type(command))
+            if handler is None:
+                self.logger.error("Unrecognized command: '%s'", command)
+                continue
+            try:
+                handler(command)
             except:
-                self.logger.error("Unrecognized command: '{}'".format(command))
+                self.logger.error("Problem executing command: '%s'", command)
+
+    # Time (s) until the main loop has something to do by itself (next led animation step, alt-mode check)
+    def getWaitTimeout(self):
+        timeout = self.maxWaitPeriod
+        if self.altMode:
+            timeout = min(timeout, self.altModeCheckPeriod)
+        animationTimeout = self.ledAnimation.getTimeout()
+        if animationTimeout is not None:
+            timeout = min(timeout, animationTimeout)
+        return max(0, timeout)
+                
+    def setNetworkAndRoom(self, command):
+        self.logger.debug("Command NETWORK ({:d}) / ROOM ({:d})".format(command.networkIndex, command.roomIndex))
+        self.setActiveSpeakerLeds(command.networkIndex, command.roomIndex)
+        
+    def setProgress(self, command):
+        self.logger.debug("Command PROGRESS {} ({}%)".format("START" if command.active else "STOP", command.percent))
+        self.progress = command.active
+        self.progressPercent = command.percent
+        self.logger.debug("self.progress: {}".format(self.progress))
 
+    def logDiagnostics(self, command):
+        self.logger.debug("Command DIAGNOSTICS")
+        for line in self.mcp.getStats():
+            self.logger.debug("MCP transactions: {}".format(line))
 
                     
     def run(self, stopper=None, u2pQueue=None, p2uQueue=None, reset=None):
@@ -818,16 +846,24 @@ class UserInterface:
             self.p2uQueue = p2uQueue
 
             self.reset = reset
+
+            # Wake up on new commands and on stop
+            if self.p2uQueue is not None and hasattr(self.p2uQueue, 'addListener'):
+                self.p2uQueue.addListener(self.wake)
+            if self.stopper is not None and hasattr(self.stopper, 'link'):
+                self.stopper.link(self.wake)
               
             while True:
-                sleep(0.1)  # sleep 100 msec       
-                                                    # because of threading make sure no thread
-                                                    # changes value until we get them
-                                                    # and reset them
-                                                    
+                self.wake.wait(self.getWaitTimeout())
+                # Cleared before processing: Whatever happens from now on wakes up the next iteration
+                self.wake.clear()
+
                 self.processRotary()
                 
-                self.checkAltMode()
+                if self.altMode:
+                    self.checkAltMode()
+                    
+                self.reconcileMcpInputs()
 
                 self.processCommands()
                     
@@ -842,9 +878,7 @@ class UserInterface:
                     except:
                         pass
                     
-                self.blinkLedsForShift()
-                self.blinkLedsForAltPlaylist()
-                self.cycleSpeakerLedsForProgress()
+                self.updateLeds()
  
         except KeyboardInterrupt:
             self.logger.info("Stop (Ctrl-C from main loop)") 
@@ -881,6 +915,7 @@ class UserInterface:
 
     def requestStop(self):
         self.stopRequested = True
+        self.wake.set()
 
 if __name__ == '__main__':
     # Logging
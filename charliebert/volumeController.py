@@ -0,0 +1,73 @@
+import time
+
+
+# Coalesces the volume changes requested by the rotary encoder: Pending deltas are merged
+# into a single target, which the player approaches by steps of at most maxStep, at most
+# once every minInterval seconds (instead of one read-modify-write on the player per detent).
+class VolumeController:
+    def __init__(self, logger, maxStep=10, minInterval=0.3):
+        self.logger = logger
+        self.maxStep = maxStep
+        self.minInterval = minInterval
+
+        # Volume change not applied yet
+        self.pendingDelta = 0
+        self.lastStepTime = 0
+
+        # Statistics
+        # Volume commands received
+        self.nbRequests = 0
+        # Commands merged into a change which was still pending
+        self.nbMerged = 0
+        # Pending changes abandoned (failure, or other room/player selected)
+        self.nbDropped = 0
+        # Steps actually applied on the player
+        self.nbSteps = 0
+
+    def add(self, volumeDelta):
+        self.nbRequests += 1
+        if self.pendingDelta != 0:
+            self.nbMerged += 1
+        self.pendingDelta += volumeDelta
+
+    def isPending(self):
+        return self.pendingDelta != 0
+
+    # Time (s) to wait before the next step is due (None if nothing is pending)
+    def getTimeout(self):
+        if self.pendingDelta == 0:
+            return None
+        return max(0, self.lastStepTime + self.minInterval - time.time())
+
+    # Apply the next step with adjust(volumeDelta) if it is due.
+    # If adjust fails (returns False or raises), the rest of the pending change is dropped
+    def step(self, adjust):
+        if self.pendingDelta == 0 or time.time() < self.lastStepTime + self.minInterval:
+            return
+
+        volumeDelta = max(-self.maxStep, min(self.maxStep, self.pendingDelta))
+        self.pendingDelta -= volumeDelta
+        self.lastStepTime = time.time()
+        try:
+            applied = adjust(volumeDelta)
+        except:
+            applied = False
+        if not applied:
+            self.logger.error("Problem adjusting the volume by {:d}".format(volumeDelta))
+            # The failed step is abandoned along with the rest of the change
+            self.pendingDelta += volumeDelta
+            self.drop()
+            return
+        self.nbSteps += 1
+
+        self.logger.debug("Volume step {:d} (still pending: {:d}; {})".format(volumeDelta, self.pendingDelta, self.getStats()))
+
+    def drop(self):
+        if self.pendingDelta != 0:
+            self.nbDropped += 1
+            self.logger.debug("Dropping pending volume change {:d}".format(self.pendingDelta))
+            self.pendingDelta = 0
+
+    def getStats(self):
+        return "{:d} volume commands, {:d} merged, {:d} dropped, {:d} steps".format(self.nbRequests, self.nbMerged,
+                                                                                 self.nbDropped, self.nbSteps)